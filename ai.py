@@ -1,83 +1,221 @@
+import asyncio
+import contextlib
+import importlib
 import os
+import threading
+import httpx
 from llm_config import LLM_PROVIDERS
+import chat_context
+import metrics
 
-# Import individual LLM clients
-from together import Together
-import openai
-import google.generativeai as genai
-from langchain_together import TogetherEmbeddings
+from embedding_cache import CachedEmbeddings, EmbeddingStore
+from ingestion import TogetherBatchEmbeddings
+
+EMBEDDING_MODEL = "togethercomputer/m2-bert-80M-8k-retrieval"
 
 # New function to get embedding client for FastAPI startup
-def get_embedding_client():
-    """Initializes and returns the TogetherEmbeddings client."""
+def get_embedding_client(cache_path: str = None):
+    """
+    Initializes and returns the Together embeddings client, which embeds document chunks in concurrent batches.
+    If `cache_path` is given, it is wrapped in a persistent embedding cache stored at that path.
+    """
     api_key = os.getenv("TOGETHER_API_KEY")
     if not api_key:
         raise ValueError("TOGETHER_API_KEY not found in environment variables.")
-    return TogetherEmbeddings(model="togethercomputer/m2-bert-80M-8k-retrieval", api_key=api_key)
+    embeddings = TogetherBatchEmbeddings(model=EMBEDDING_MODEL, api_key=api_key)
+    if cache_path:
+        embeddings = CachedEmbeddings(embeddings, EMBEDDING_MODEL, EmbeddingStore(cache_path))
+    return embeddings
 
-def get_ai_response(
-    provider: str,
-    system_prompt: str,
-    messages: list,
-    vector_store=None,
-    use_rag=True
-) -> str:
+# --- Provider Client Registry ---
+# Provider SDKs take seconds to import, so each is imported by _create_client when its client is first created.
+PROVIDER_SDKS = {"TogetherAI": "together", "OpenAI": "openai", "Google": "google.generativeai"}
+
+# Guards client creation, so two first calls to a provider cannot each build (and leak) a connection pool.
+_client_lock = threading.Lock()
+
+def create_provider_clients() -> dict:
     """
-    Generates a response from the specified LLM provider, augmented with RAG context.
+    Returns an empty registry of provider clients, meant to be created once at startup and shared.
+    Each pooled async client is created lazily by _get_client on its provider's first call, so the
+    SDKs of unused providers are never imported, and is reused by every later request.
+    """
+    return {}
+
+def preload_provider_sdks():
+    """Imports the SDKs of the configured providers. Run in a thread after startup so the first call does not wait for it."""
+    for provider, config in LLM_PROVIDERS.items():
+        if os.getenv(config["api_key_env"]):
+            importlib.import_module(PROVIDER_SDKS[provider])
+
+def _create_client(provider: str, api_key: str):
+    config = LLM_PROVIDERS[provider]
+    if provider == "Google":
+        # The Gemini SDK keeps one process-wide gRPC channel that multiplexes all calls; configure it
+        # once with this provider's key instead of whatever key the SDK found in the environment.
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        return genai
+    limits = httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_connections"],
+    )
+    if provider == "TogetherAI":
+        import together
+        return together.AsyncTogether(
+            api_key=api_key,
+            timeout=config["timeout_s"],
+            http_client=together.DefaultAsyncHttpxClient(limits=limits, timeout=config["timeout_s"]),
+        )
+    import openai
+    return openai.AsyncOpenAI(
+        api_key=api_key,
+        timeout=config["timeout_s"],
+        http_client=openai.DefaultAsyncHttpxClient(limits=limits, timeout=config["timeout_s"]),
+    )
+
+async def close_provider_clients(clients: dict):
+    """Closes the HTTP connection pools held by the provider clients."""
+    for provider, client in clients.items():
+        if provider in ("TogetherAI", "OpenAI"):
+            await client.close()
+
+_default_clients = None
+
+def get_default_provider_clients() -> dict:
+    """Returns a lazily created process-wide registry, for callers outside the FastAPI app."""
+    global _default_clients
+    with _client_lock:
+        if _default_clients is None:
+            _default_clients = create_provider_clients()
+    return _default_clients
+
+def _get_client(clients: dict, provider: str):
+    client = clients.get(provider)
+    if client is not None:
+        return client
+    with _client_lock:
+        if provider not in clients:
+            api_key = os.getenv(LLM_PROVIDERS[provider]["api_key_env"])
+            if not api_key:
+                raise ValueError(f"API key for {provider} not found in environment variables.")
+            clients[provider] = _create_client(provider, api_key)
+        return clients[provider]
+
+# --- Concurrency Limits ---
+# One semaphore per provider caps the number of in-flight calls from this worker.
+_provider_semaphores = {}
+
+def _get_provider_semaphore(provider: str) -> asyncio.Semaphore:
+    if provider not in _provider_semaphores:
+        _provider_semaphores[provider] = asyncio.Semaphore(LLM_PROVIDERS[provider]["max_concurrency"])
+    return _provider_semaphores[provider]
+
+@contextlib.asynccontextmanager
+async def _provider_call(provider: str):
+    """Holds one of the provider's concurrency slots, timing the wait as the llm_queue stage and the call as llm."""
+    semaphore = _get_provider_semaphore(provider)
+    with metrics.stage("llm_queue", provider):
+        await semaphore.acquire()
+    try:
+        with metrics.stage("llm", provider):
+            yield
+    finally:
+        semaphore.release()
+
+async def _build_api_messages(provider: str, system_prompt: str, messages: list, vector_store=None, use_rag=True, summary: str = None):
+    """
+    Validates the provider and fits the conversation into the provider's context budget.
+    The system prompt (with the rolling summary, if any) and the new question always go in;
+    retrieved chunks may use up to a fixed share of the budget, and history fills the rest,
+    newest turns first. Returns the provider config, system prompt, message history and the final prompt.
     """
     if provider not in LLM_PROVIDERS:
         raise ValueError(f"Unsupported LLM provider: {provider}")
 
     config = LLM_PROVIDERS[provider]
-    api_key = os.getenv(config["api_key_env"])
-    if not api_key:
-        raise ValueError(f"API key for {provider} not found in environment variables.")
-
-    # 1. Augment prompt with RAG context if applicable
+    model = config["model"]
+    budget = config["context_budget_tokens"]
+    system_prompt = chat_context.with_summary(system_prompt, summary)
     prompt = messages[-1]['content']
+    fixed_tokens = chat_context.count_message_tokens(
+        [{"content": system_prompt}, {"content": prompt}], model
+    )
+
+    # 1. Augment prompt with as much RAG context as the budget allows
     context = ""
     if vector_store and use_rag:
-        docs = vector_store.similarity_search(prompt, k=3)
-        context = "\n\n---\n\nContext from uploaded document:\n" + "\n".join([d.page_content for d in docs])
+        # Embeds the query asynchronously; the FAISS search itself runs in an executor.
+        with metrics.stage("query_embedding"):
+            embedding = await vector_store.embeddings.aembed_query(prompt)
+        with metrics.stage("similarity_search"):
+            docs = await vector_store.asimilarity_search_by_vector(embedding, k=chat_context.RAG_CANDIDATE_CHUNKS)
+        rag_budget = min(int(budget * chat_context.RAG_BUDGET_FRACTION), budget - fixed_tokens)
+        chunks = chat_context.fit_chunks([d.page_content for d in docs], rag_budget, model)
+        if chunks:
+            context = "\n\n---\n\nContext from uploaded document:\n" + "\n".join(chunks)
 
     final_prompt_content = prompt + context
 
-    # Construct the full message history for the API call
-    api_messages = messages[:-1] + [{"role": "user", "content": final_prompt_content}]
+    # 2. Keep the newest history that still fits
+    history_budget = budget - fixed_tokens - chat_context.count_tokens(context, model)
+    _, history = chat_context.fit_history(messages[:-1], history_budget, model)
+    api_messages = history + [{"role": "user", "content": final_prompt_content}]
+    return config, system_prompt, api_messages, final_prompt_content
 
-    # 2. Dispatch to the correct LLM client
+async def get_ai_response(
+    provider: str,
+    system_prompt: str,
+    messages: list,
+    vector_store=None,
+    use_rag=True,
+    clients: dict = None,
+    summary: str = None
+) -> str:
+    """
+    Generates a response from the specified LLM provider, augmented with RAG context.
+    Uses each provider's async client, so a slow completion does not block the event loop.
+    `clients` is the registry from create_provider_clients; the process-wide default is used if omitted.
+    `summary` is the rolling summary of turns no longer passed in `messages`.
+    """
+    config, system_prompt, api_messages, final_prompt_content = await _build_api_messages(
+        provider, system_prompt, messages, vector_store, use_rag, summary
+    )
+    client = _get_client(clients if clients is not None else get_default_provider_clients(), provider)
+
+    # 3. Dispatch to the correct LLM client
     try:
-        if provider == "TogetherAI":
-            client = Together(api_key=api_key)
-            # Prepend system prompt for TogetherAI
-            full_api_messages = [{"role": "system", "content": system_prompt}] + api_messages
-            response = client.chat.completions.create(
-                model=config["model"],
-                messages=full_api_messages,
-            )
-            return response.choices[0].message.content
+        async with _provider_call(provider):
+            if provider == "TogetherAI":
+                # Prepend system prompt for TogetherAI
+                full_api_messages = [{"role": "system", "content": system_prompt}] + api_messages
+                response = await client.chat.completions.create(
+                    model=config["model"],
+                    messages=full_api_messages,
+                )
+                return response.choices[0].message.content
 
-        elif provider == "OpenAI":
-            openai.api_key = api_key
-            # Prepend system prompt for OpenAI
-            full_api_messages = [{"role": "system", "content": system_prompt}] + api_messages
-            response = openai.chat.completions.create(
-                model=config["model"],
-                messages=full_api_messages,
-            )
-            return response.choices[0].message.content
+            elif provider == "OpenAI":
+                # Prepend system prompt for OpenAI
+                full_api_messages = [{"role": "system", "content": system_prompt}] + api_messages
+                response = await client.chat.completions.create(
+                    model=config["model"],
+                    messages=full_api_messages,
+                )
+                return response.choices[0].message.content
 
-        elif provider == "Google":
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(
-                model_name=config["model"],
-                system_instruction=system_prompt
-            )
-            # Google's format is slightly different; it doesn't use the "role" for history in the same way for a simple chat.
-            # We'll need to format the history. For simplicity, we'll just send the final prompt.
-            # A more robust implementation would handle the conversation history formatting.
-            response = model.generate_content(final_prompt_content)
-            return response.text
+            elif provider == "Google":
+                model = client.GenerativeModel(
+                    model_name=config["model"],
+                    system_instruction=system_prompt
+                )
+                # Google's format is slightly different; it doesn't use the "role" for history in the same way for a simple chat.
+                # We'll need to format the history. For simplicity, we'll just send the final prompt.
+                # A more robust implementation would handle the conversation history formatting.
+                response = await model.generate_content_async(
+                    final_prompt_content, request_options={"timeout": config["timeout_s"]}
+                )
+                return response.text
 
     except Exception as e:
         print(f"Error calling {provider} API: {e}")
@@ -85,3 +223,45 @@ def get_ai_response(
         return f"An error occurred while communicating with the {provider} API. Please check the backend logs."
 
     return "Error: No response from AI."
+
+async def stream_ai_response(
+    provider: str,
+    system_prompt: str,
+    messages: list,
+    vector_store=None,
+    use_rag=True,
+    clients: dict = None,
+    summary: str = None
+):
+    """
+    Same as get_ai_response, but yields the response text piece by piece as the provider streams it.
+    Provider errors are raised to the caller, since part of the response may already have been sent.
+    """
+    config, system_prompt, api_messages, final_prompt_content = await _build_api_messages(
+        provider, system_prompt, messages, vector_store, use_rag, summary
+    )
+    client = _get_client(clients if clients is not None else get_default_provider_clients(), provider)
+
+    async with _provider_call(provider):
+        if provider == "TogetherAI":
+            full_api_messages = [{"role": "system", "content": system_prompt}] + api_messages
+            stream = await client.chat.completions.create(model=config["model"], messages=full_api_messages, stream=True)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        elif provider == "OpenAI":
+            full_api_messages = [{"role": "system", "content": system_prompt}] + api_messages
+            stream = await client.chat.completions.create(model=config["model"], messages=full_api_messages, stream=True)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        elif provider == "Google":
+            model = client.GenerativeModel(model_name=config["model"], system_instruction=system_prompt)
+            response = await model.generate_content_async(
+                final_prompt_content, stream=True, request_options={"timeout": config["timeout_s"]}
+            )
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
@@ -1,7 +1,9 @@
 import streamlit as st
 import requests
 from dotenv import load_dotenv
+import json
 import os
+import time
 
 from collections import defaultdict
 import datetime
@@ -16,7 +18,35 @@ load_dotenv()
 st.set_page_config(page_title="Educational AI Platform", page_icon="🎓", layout="wide")
 API_BASE_URL = os.getenv("API_BASE_URL", "http://127.0.0.1:8000")
 
-def api_request(method: str, endpoint: str, data: dict = None, files: dict = None):
+API_TIMEOUT_S = float(os.getenv("API_TIMEOUT_S", 30))
+# Sidebar reads are served from the session for this long unless an action invalidates them first.
+API_READ_CACHE_TTL_S = float(os.getenv("API_READ_CACHE_TTL_S", 60))
+# How long the upload page follows an ingestion job before leaving it to finish in the background.
+INGESTION_POLL_TIMEOUT_S = float(os.getenv("INGESTION_POLL_TIMEOUT_S", 300))
+
+def get_http_session() -> requests.Session:
+    """Returns this browser session's pooled HTTP session, so calls reuse keep-alive connections to the backend."""
+    if "http_session" not in st.session_state:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        st.session_state.http_session = session
+    return st.session_state.http_session
+
+def set_access_token(token):
+    """
+    Replaces (or, given None, drops) the session's token. Cached reads and the open chat session
+    belong to the previous user, so they are dropped along with it.
+    """
+    st.session_state.pop("api_read_cache", None)
+    st.session_state.pop("chat_session_id", None)
+    if token is None:
+        st.session_state.pop("access_token", None)
+    else:
+        st.session_state.access_token = token
+
+def api_request(method: str, endpoint: str, data: dict = None, files: dict = None, form: dict = None):
     try:
         url = f"{API_BASE_URL}/{endpoint}"
 
@@ -24,22 +54,22 @@ def api_request(method: str, endpoint: str, data: dict = None, files: dict = Non
         if "access_token" in st.session_state:
             headers["Authorization"] = f"Bearer {st.session_state.access_token}"
 
+        session = get_http_session()
         if method.upper() == "GET":
-            response = requests.get(url, headers=headers)
+            response = session.get(url, headers=headers, timeout=API_TIMEOUT_S)
         elif method.upper() == "POST":
-            response = requests.post(url, json=data, files=files, headers=headers)
+            response = session.post(url, json=data, data=form, files=files, headers=headers, timeout=API_TIMEOUT_S)
         elif method.upper() == "PUT":
-            response = requests.put(url, json=data, files=files, headers=headers)
+            response = session.put(url, json=data, files=files, headers=headers, timeout=API_TIMEOUT_S)
         elif method.upper() == "DELETE":
-            response = requests.delete(url, headers=headers)
+            response = session.delete(url, headers=headers, timeout=API_TIMEOUT_S)
         else:
             st.error(f"Unsupported HTTP method: {method}")
             return None
 
         if response.status_code == 401:
             st.error("Authentication failed. Please log in again.")
-            if "access_token" in st.session_state:
-                del st.session_state["access_token"]
+            set_access_token(None)
             st.rerun()
             return None
 
@@ -49,6 +79,51 @@ def api_request(method: str, endpoint: str, data: dict = None, files: dict = Non
         st.error(f"API request failed: {e}")
         return None
 
+def api_get_cached(endpoint: str):
+    """GETs a read endpoint, reusing this session's response until it expires or is invalidated."""
+    cache = st.session_state.setdefault("api_read_cache", {})
+    entry = cache.get(endpoint)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    result = api_request("GET", endpoint)
+    if result is not None:
+        cache[endpoint] = (time.monotonic() + API_READ_CACHE_TTL_S, result)
+    return result
+
+def invalidate_api_cache(*endpoints: str):
+    """Drops cached reads made stale by an action, so the next rerun fetches them again."""
+    cache = st.session_state.get("api_read_cache", {})
+    for endpoint in endpoints:
+        cache.pop(endpoint, None)
+
+def api_stream(endpoint: str, data: dict):
+    """Posts to a server-sent events endpoint and yields the text of each message event as it arrives."""
+    url = f"{API_BASE_URL}/{endpoint}"
+    headers = {"Accept": "text/event-stream"}
+    if "access_token" in st.session_state:
+        headers["Authorization"] = f"Bearer {st.session_state.access_token}"
+
+    # The read timeout bounds the wait between streamed pieces, not the whole reply.
+    with get_http_session().post(url, json=data, headers=headers, stream=True, timeout=API_TIMEOUT_S) as response:
+        if response.status_code == 401:
+            st.error("Authentication failed. Please log in again.")
+            set_access_token(None)
+            st.rerun()
+        response.raise_for_status()
+
+        event = "message"
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                event = "message" # A blank line ends the current event
+            elif line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                payload = json.loads(line[len("data:"):])
+                if event == "message":
+                    yield payload["content"]
+                elif event == "error":
+                    raise RuntimeError(payload["detail"])
+
 # --- UI Components ---
 
 def draw_login_screen():
@@ -63,12 +138,13 @@ def draw_login_screen():
             if submitted and username and password:
                 with st.spinner("Authenticating..."):
                     try:
-                        response = requests.post(
+                        response = get_http_session().post(
                             f"{API_BASE_URL}/token",
-                            data={"username": username, "password": password}
+                            data={"username": username, "password": password},
+                            timeout=API_TIMEOUT_S
                         )
                         if response.ok:
-                            st.session_state.access_token = response.json()["access_token"]
+                            set_access_token(response.json()["access_token"])
                             # Get user details after login
                             user_details = api_request("GET", "users/me")
                             if user_details:
@@ -94,6 +170,33 @@ def draw_login_screen():
                 else:
                     st.error("Registration failed.")
 
+def draw_ingestion_progress(job_id: str, filename: str):
+    """Polls a background ingestion job and shows its progress until it finishes or INGESTION_POLL_TIMEOUT_S passes."""
+    progress_bar = st.progress(0.0, text=f"Processing '{filename}'...")
+    deadline = time.monotonic() + INGESTION_POLL_TIMEOUT_S
+    while True:
+        job = api_request("GET", f"documents/jobs/{job_id}")
+        if not job:
+            progress_bar.empty()
+            return
+        if job["status"] == "completed":
+            progress_bar.empty()
+            st.success(f"Document '{filename}' processed successfully!")
+            st.session_state.doc_id = job["doc_id"]
+            invalidate_api_cache("documents", "storage-usage")
+            return
+        if job["status"] == "failed":
+            progress_bar.empty()
+            invalidate_api_cache("storage-usage")
+            st.error(f"Failed to process document: {job.get('error')}")
+            return
+        if time.monotonic() > deadline:
+            progress_bar.empty()
+            st.info(f"'{filename}' is still processing. Check back later; it will appear in your documents once done.")
+            return
+        progress_bar.progress(job["progress"], text=f"Processing '{filename}': {job['stage']}...")
+        time.sleep(1)
+
 def draw_rag_ui():
     st.header("🧠 Knowledge Base (RAG)")
     # --- RAG UI for uploading files and managing knowledge base ---
@@ -103,36 +206,52 @@ def draw_rag_ui():
 
     if uploaded_file and category:
         if st.button("Upload & Process Document"):
-            with st.spinner("Uploading and processing..."):
+            with st.spinner("Uploading..."):
                 files = {'file': (uploaded_file.name, uploaded_file.getvalue(), uploaded_file.type)}
-                response = api_request("POST", f"documents?category={category}", files=files)
-                if response:
-                    st.success(f"Document '{uploaded_file.name}' processed successfully!")
-                    st.session_state.doc_id = response.get("doc_id")
-                else:
-                    st.error("Failed to upload document.")
+                response = api_request("POST", "documents", files=files, form={"category": category})
+            if response:
+                draw_ingestion_progress(response["job_id"], uploaded_file.name)
+            else:
+                st.error("Failed to upload document.")
     
     st.subheader("Your Documents")
-    docs_response = api_request("GET", "documents")
+    docs_response = api_get_cached("documents")
     if docs_response:
         docs = docs_response
-        selected_doc_id = st.selectbox(
-            "Select a document to use for RAG:",
-            options=[d['id'] for d in docs],
-            format_func=lambda x: next((d['filename'] for d in docs if d['id'] == x), x),
-            key="rag_doc_selector"
+        scope_type = st.radio(
+            "Search in:", ["document", "category", "library"],
+            format_func=lambda x: {"document": "One document", "category": "A category", "library": "All my documents"}[x],
+            horizontal=True, key="rag_scope_type"
         )
-        if selected_doc_id:
-            st.session_state.rag_scope = {"scope_type": "document", "scope_id": selected_doc_id}
-            st.info(f"Using document: **{selected_doc_id}** for RAG.")
+        if scope_type == "document":
+            selected_doc_id = st.selectbox(
+                "Select a document to use for RAG:",
+                options=[d['id'] for d in docs],
+                format_func=lambda x: next((d['filename'] for d in docs if d['id'] == x), x),
+                key="rag_doc_selector"
+            )
+            if selected_doc_id:
+                st.session_state.rag_scope = {"scope_type": "document", "scope_id": selected_doc_id}
+                st.info(f"Using document: **{selected_doc_id}** for RAG.")
+            else:
+                st.session_state.rag_scope = None
+        elif scope_type == "category":
+            selected_category = st.selectbox(
+                "Select a category to use for RAG:",
+                options=sorted({d['category'] for d in docs}),
+                key="rag_category_selector"
+            )
+            st.session_state.rag_scope = {"scope_type": "category", "scope_id": selected_category}
+            st.info(f"Using all **{selected_category}** documents for RAG.")
         else:
-            st.session_state.rag_scope = None
+            st.session_state.rag_scope = {"scope_type": "library", "scope_id": ""}
+            st.info(f"Using all {len(docs)} of your documents for RAG.")
     else:
         st.info("No documents uploaded yet.")
 
 def draw_storage_usage_ui():
     st.subheader("📦 Storage Usage")
-    usage_response = api_request("GET", "storage-usage")
+    usage_response = api_get_cached("storage-usage")
     if usage_response:
         usage = usage_response.get("usage_mb", 0)
         limit = usage_response.get("limit_mb", 100)
@@ -155,22 +274,28 @@ def draw_chat_interface():
             st.markdown(prompt)
 
         with st.chat_message("assistant"):
-            with st.spinner("AI is thinking..."):
-                payload = {
-                    "messages": st.session_state.messages,
-                    "persona": st.session_state.get("ai_persona", "You are a helpful expert."),
-                    "educational_level": st.session_state.get("educational_level", ""),
-                    "llm_provider": st.session_state.get("llm_provider", "TogetherAI"),
-                    "rag_scope": st.session_state.get("rag_scope")
-                }
-                response_data = api_request("POST", "chat", data=payload)
-                if response_data:
-                    ai_response = response_data.get("content")
-                    st.markdown(ai_response)
-                    st.session_state.messages.append({"role": "assistant", "content": ai_response})
-                else:
+            if "chat_session_id" not in st.session_state:
+                session = api_request("POST", "chat/sessions")
+                if not session:
                     st.session_state.messages.pop()
-                    st.error("Failed to get response from the backend.")
+                    return
+                st.session_state.chat_session_id = session["id"]
+            # Only the new turn is sent; the backend rebuilds the conversation from the stored session.
+            payload = {
+                "message": prompt,
+                "session_id": st.session_state.chat_session_id,
+                "persona": st.session_state.get("ai_persona", "You are a helpful expert."),
+                "educational_level": st.session_state.get("educational_level", ""),
+                "llm_provider": st.session_state.get("llm_provider", "TogetherAI"),
+                "rag_scope": st.session_state.get("rag_scope")
+            }
+            try:
+                # Tokens are rendered as they arrive instead of behind a spinner.
+                ai_response = st.write_stream(api_stream("chat/stream", payload))
+                st.session_state.messages.append({"role": "assistant", "content": ai_response})
+            except (requests.exceptions.RequestException, RuntimeError) as e:
+                st.session_state.messages.pop()
+                st.error(f"Failed to get response from the backend: {e}")
 
 def draw_educator_ui():
     st.header(f"Educator Dashboard: {st.session_state.username}")
@@ -195,7 +320,7 @@ def draw_student_ui():
         draw_chat_interface()
     with tab2:
         st.subheader("Your Assignments")
-        assignments_response = api_request("GET", "assignments/student")
+        assignments_response = api_get_cached("assignments/student")
         if assignments_response and assignments_response.get("assignments"):
             for assignment in assignments_response["assignments"]:
                 with st.expander(f"**{assignment['title']}** (Due: {assignment.get('due_date', 'N/A')})"):
@@ -206,6 +331,7 @@ def draw_student_ui():
                             with st.spinner("Submitting and grading..."):
                                 payload = {"assignment_id": assignment['id'], "content": submission_content}
                                 grade_response = api_request("POST", "submissions/grade", data=payload)
+                                invalidate_api_cache("assignments/student")
                                 if grade_response:
                                     st.success("Submission Graded!")
                                     st.metric(label="Your Grade", value=f"{grade_response.get('grade', 0)} / 100")
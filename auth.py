@@ -1,10 +1,20 @@
+import asyncio
 import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Optional, Tuple
+import bcrypt
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from dotenv import load_dotenv
+from fastapi import HTTPException
 from fastapi.security import OAuth2PasswordBearer
+
+import database
+from models import User
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 load_dotenv()
@@ -15,22 +25,107 @@ load_dotenv()
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "a_super_secret_key_for_development")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# If true, a token's role and school claims are used as-is, so requests skip Firestore entirely.
+# Role or school changes then take effect when the user's token expires.
+TRUST_TOKEN_CLAIMS = os.getenv("AUTH_TRUST_TOKEN_CLAIMS", "false").lower() == "true"
 
 # --- Password Hashing ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost factor for new hashes. Existing hashes with a different cost are rehashed at the next login.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+
+def _password_bytes(password: str) -> bytes:
+    # bcrypt only uses the first 72 bytes of a password.
+    return password.encode("utf-8")[:72]
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifies a plain password against a hashed one."""
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return bcrypt.checkpw(_password_bytes(plain_password), hashed_password.encode("utf-8"))
+    except ValueError: # Malformed hash
+        return False
 
 def get_password_hash(password: str) -> str:
     """Hashes a plain password."""
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode("utf-8")
+
+def needs_rehash(hashed_password: str) -> bool:
+    """True if a hash was made with a cost factor other than BCRYPT_ROUNDS."""
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def verify_and_update(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verifies a password and, if the stored hash uses an outdated cost, rehashes it.
+    Returns (verified, new_hash); new_hash is None when the stored hash is current.
+    """
+    if not verify_password(plain_password, hashed_password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, get_password_hash(plain_password)
+    return True, None
+
+class PasswordHasherBusy(Exception):
+    """Raised when the password hashing pool already has its maximum number of queued jobs."""
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a dedicated, bounded thread pool so logins never block the event loop.
+
+    bcrypt releases the GIL, so `max_workers` hashes run in parallel. At most `max_queue` more
+    may wait; beyond that, calls fail fast with PasswordHasherBusy so a login storm sheds load
+    instead of queueing unboundedly behind other traffic.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hashing")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify_and_update(self, plain_password: str, hashed_password: Optional[str]) -> Tuple[bool, Optional[str]]:
+        """Like verify_and_update. With no stored hash, a dummy hash is checked so unknown users take as long as known ones."""
+        if hashed_password is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = await self._run(get_password_hash, uuid.uuid4().hex)
+            await self._run(verify_password, plain_password, self._dummy_hash)
+            return False, None
+        return await self._run(verify_and_update, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": self._in_flight, "capacity": self.max_workers + self.max_queue, "rejected": self.rejected}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, func, *args):
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self._in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
 
 # --- JWT Token Creation ---
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    """Creates a new JWT access token."""
+    """
+    Creates a new JWT access token.
+    Each token gets a unique id (`jti`); callers may add `role` and `school_id` claims to `data`.
+    """
     to_encode = data.copy()
+    to_encode.setdefault("jti", uuid.uuid4().hex)
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
@@ -42,11 +137,85 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 # --- JWT Token Decoding/Validation (will be used in dependencies) ---
 def decode_access_token(token: str) -> Optional[str]:
     """Decodes an access token and returns the username (sub)."""
+    payload = decode_access_token_payload(token)
+    return payload["sub"] if payload else None
+
+def decode_access_token_payload(token: str) -> Optional[dict]:
+    """Decodes and validates an access token. Returns its claims, or None if it is invalid or has no subject."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        return username
     except JWTError:
         return None
+    return payload if payload.get("sub") else None
+
+# --- Authenticated User Resolution ---
+class UserCache:
+    """
+    A short-lived, size-bounded cache of resolved users, keyed by (username, token id).
+    Entries expire after `ttl_s`; call `invalidate_user` when a user's role or school changes.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (username, token_id) -> (User, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, username: str, token_id: str) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get((username, token_id))
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end((username, token_id))
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[(username, token_id)]
+            self.misses += 1
+            return None
+
+    def put(self, username: str, token_id: str, user: User):
+        with self._lock:
+            self._entries[(username, token_id)] = (user, time.monotonic() + self.ttl_s)
+            self._entries.move_to_end((username, token_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, username: str):
+        """Drops every cached entry for a user, whichever token it was resolved from."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == username]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "entries": len(self._entries), "max_entries": self.max_entries}
+
+def get_current_active_user(db, token: str, cache: Optional[UserCache] = None) -> User:
+    """
+    Resolves the user an access token belongs to, raising 401 if the token is invalid or the user is gone.
+    Uses the token's role/school claims when TRUST_TOKEN_CLAIMS is set, then `cache`, then Firestore.
+    """
+    payload = decode_access_token_payload(token)
+    if payload is None:
+        raise HTTPException(status_code=401, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    username = payload["sub"]
+    if TRUST_TOKEN_CLAIMS and "role" in payload:
+        return User(username=username, role=payload["role"], school_id=payload.get("school_id"))
+
+    token_id = payload.get("jti") or token
+    user = cache.get(username, token_id) if cache else None
+    if user is None:
+        user_data = database.get_user(db, username)
+        if user_data is None:
+            raise HTTPException(status_code=401, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+        user = User(username=username, role=user_data.get("role", ""), school_id=user_data.get("school_id"))
+        if cache:
+            cache.put(username, token_id, user)
+    return user
+
+def is_educator(user: User) -> bool:
+    return user.role.lower() == "educator"
@@ -0,0 +1,244 @@
+"""
+End-to-end latency and throughput of the FastAPI backend, fully offline.
+
+Boots main.app through its real lifespan with in-process fakes for Firestore, GCS, the LLM
+providers and the embeddings API, each with configurable latency, then drives a weighted
+mix of requests from concurrent virtual users:
+
+    token      POST /token
+    chat       POST /chat without RAG
+    chat_rag   POST /chat over a seeded document
+    upload     POST /documents (a text file; ingestion runs in the background)
+    grade      POST /submissions/grade
+
+It prints p50/p95/p99 latency and throughput per request type plus the process's peak RSS,
+and can save the results as JSON and compare them with an earlier run.
+
+Usage (from the repository root):
+    python -m benchmarks.backend_benchmark --concurrency 32 --duration 30 --output results.json
+    python -m benchmarks.backend_benchmark --mix chat=5,chat_rag=3,grade=1 --compare results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BUCKET = "benchmark-bucket"
+PASSWORD = "benchmark-password"
+DEFAULT_MIX = "token=1,chat=4,chat_rag=3,upload=1,grade=1"
+
+
+def configure_environment(args):
+    # Read by main.py and the modules it imports, so this must run before they are imported.
+    os.environ["GCS_BUCKET_NAME"] = BUCKET
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    os.environ["INGESTION_PARSE_PROCESSES"] = "0"
+    os.environ["STORAGE_RECONCILE_INTERVAL_S"] = "0"
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(tempfile.mkdtemp(), "embeddings.sqlite3")
+    os.environ["VECTOR_STORE_DISK_CACHE_DIR"] = tempfile.mkdtemp()
+    os.environ.setdefault("USER_STORAGE_LIMIT_MB", "100000")
+
+
+def install_fakes(args):
+    """Replaces every external service used during startup with its fake. Returns the fake clients."""
+    import ai
+    import database
+    import gcs_transfer
+    from benchmarks import fake_firestore
+    from benchmarks.fake_ai import FakeChatClient, FakeEmbeddings
+    from benchmarks.fake_gcs import FakeStorageClient
+
+    db = fake_firestore.install(fake_firestore.FakeFirestoreClient(latency_s=args.firestore_ms / 1000))
+    storage = FakeStorageClient(latency_s=args.gcs_ms / 1000, bandwidth_mb_s=args.gcs_bandwidth_mb_s)
+    llm = FakeChatClient(first_token_s=args.llm_first_token_ms / 1000, token_s=args.llm_token_ms / 1000)
+    embeddings = FakeEmbeddings(latency_s=args.embedding_ms / 1000)
+
+    database.init_firestore = lambda: db
+    gcs_transfer.set_storage_client(storage)
+    ai.create_provider_clients = lambda: {"TogetherAI": llm}
+    ai.get_embedding_client = lambda cache_path=None: embeddings
+    return db, embeddings
+
+
+def seed(db, embeddings, num_users: int):
+    """Creates users, one indexed document each, and an assignment. Returns {username: access_token}."""
+    from langchain_core.documents import Document
+
+    import auth
+    import database
+    import rag
+
+    hashed_password = auth.get_password_hash(PASSWORD)
+    tokens = {}
+    for i in range(num_users):
+        username = f"student{i}"
+        database.create_user(db, username, hashed_password, "student")
+        tokens[username] = auth.create_access_token({"sub": username, "role": "student", "school_id": None})
+        docs = [Document(page_content=f"Section {j} of the {username} notes. " + "Photosynthesis converts light. " * 40)
+                for j in range(20)]
+        vector_store = rag.create_vector_store(docs, embeddings)
+        gcs_path = f"vector_stores/{username}/doc-{i}"
+        rag.save_vector_store_to_gcs(vector_store, BUCKET, gcs_path)
+        database.add_document_metadata(db, username, gcs_path, "Biology", "notes.txt", f"doc-{i}")
+    assignment_id = database.create_assignment(
+        db, "teacher", "Essay", "Explain photosynthesis in 200 words.", None, assign=False
+    )
+    return tokens, assignment_id
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+async def run_benchmark(args):
+    configure_environment(args)
+    import main
+
+    db, embeddings = install_fakes(args)
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    samples = {name: [] for name in weights}
+    errors = {name: 0 for name in weights}
+    upload_body = ("Cells need energy. " * 20 + "\n") * args.upload_lines
+
+    async with main.app.router.lifespan_context(main.app):
+        tokens, assignment_id = await asyncio.get_running_loop().run_in_executor(
+            None, seed, db, embeddings, args.concurrency
+        )
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+
+            async def request(name: str, username: str, state: dict) -> httpx.Response:
+                headers = {"Authorization": f"Bearer {tokens[username]}"}
+                chat = {"persona": "You are a helpful tutor.", "educational_level": "high school", "llm_provider": "TogetherAI"}
+                if name == "token":
+                    return await client.post("/token", data={"username": username, "password": PASSWORD})
+                if name in ("chat", "chat_rag"):
+                    payload = dict(chat, message=f"Question {rng.randrange(1000)} about photosynthesis?",
+                                   session_id=state.get(name))
+                    if name == "chat_rag":
+                        payload["rag_scope"] = {"scope_type": "document", "scope_id": f"doc-{username[len('student'):]}"}
+                    response = await client.post("/chat", json=payload, headers=headers)
+                    if response.status_code == 200:
+                        state[name] = response.json()["session_id"]
+                    return response
+                if name == "upload":
+                    files = {"file": (f"notes-{rng.randrange(10 ** 6)}.txt", upload_body.encode("utf-8"), "text/plain")}
+                    return await client.post("/documents", data={"category": "Biology"}, files=files, headers=headers)
+                if name == "grade":
+                    payload = {"assignment_id": assignment_id, "content": f"Essay {rng.randrange(10 ** 6)}: plants use light."}
+                    return await client.post("/submissions/grade", json=payload, headers=headers)
+                raise ValueError(f"Unknown request type: {name}")
+
+            names, cumulative = list(weights), list(weights.values())
+            deadline = time.perf_counter() + args.duration
+
+            async def virtual_user(username: str):
+                state = {}
+                while time.perf_counter() < deadline:
+                    name = rng.choices(names, cumulative)[0]
+                    start = time.perf_counter()
+                    try:
+                        response = await request(name, username, state)
+                        ok = response.status_code < 400
+                    except Exception as e:
+                        print(f"{name} raised {e!r}", file=sys.stderr)
+                        ok = False
+                    samples[name].append(time.perf_counter() - start)
+                    if not ok:
+                        errors[name] += 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(virtual_user(username) for username in tokens))
+            elapsed = time.perf_counter() - started
+
+    return summarize(args, samples, errors, elapsed)
+
+
+def percentiles_ms(latencies):
+    if len(latencies) < 2:
+        value = latencies[0] * 1000 if latencies else 0.0
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    q = statistics.quantiles(latencies, n=100)
+    return {"p50_ms": q[49] * 1000, "p95_ms": q[94] * 1000, "p99_ms": q[98] * 1000}
+
+
+def summarize(args, samples, errors, elapsed):
+    all_latencies = [latency for latencies in samples.values() for latency in latencies]
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "config": vars(args),
+        "duration_s": elapsed,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "overall": {"requests": len(all_latencies), "errors": sum(errors.values()),
+                    "throughput_rps": len(all_latencies) / elapsed, **percentiles_ms(all_latencies)},
+        "requests": {
+            name: {"requests": len(latencies), "errors": errors[name],
+                   "throughput_rps": len(latencies) / elapsed, **percentiles_ms(latencies)}
+            for name, latencies in samples.items()
+        },
+    }
+
+
+def print_results(results, baseline=None):
+    print(f"commit {results['commit']}  {results['duration_s']:.1f} s  peak RSS {results['peak_rss_mb']:.0f} MB")
+    print(f"{'request':<10} {'count':>7} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = list(results["requests"].items()) + [("overall", results["overall"])]
+    for name, stats in rows:
+        line = (f"{name:<10} {stats['requests']:>7} {stats['errors']:>6} {stats['throughput_rps']:>8.1f} "
+                f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f}")
+        previous = (baseline or {}).get("requests", {}).get(name) if name != "overall" else (baseline or {}).get("overall")
+        if previous and previous["p95_ms"]:
+            line += f"   p95 {100 * (stats['p95_ms'] / previous['p95_ms'] - 1):+.0f}% vs {baseline.get('commit')}"
+        print(line)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16, help="virtual users, each with its own account")
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="comma-separated request=weight pairs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--firestore-ms", type=float, default=10.0)
+    parser.add_argument("--gcs-ms", type=float, default=30.0)
+    parser.add_argument("--gcs-bandwidth-mb-s", type=float, default=100.0)
+    parser.add_argument("--llm-first-token-ms", type=float, default=300.0)
+    parser.add_argument("--llm-token-ms", type=float, default=5.0)
+    parser.add_argument("--embedding-ms", type=float, default=50.0)
+    parser.add_argument("--bcrypt-rounds", type=int, default=10)
+    parser.add_argument("--upload-lines", type=int, default=200, help="size of each uploaded text file")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a JSON file from an earlier run to compare p95 latencies against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
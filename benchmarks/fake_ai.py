@@ -0,0 +1,75 @@
+"""
+Deterministic stand-ins for the LLM provider clients and the embeddings client, with injectable latency.
+
+FakeChatClient answers `client.chat.completions.create(...)` the way the Together and OpenAI
+async clients do, streaming or not. Grading prompts get a JSON grade; everything else gets a
+fixed-length answer derived from the question. FakeEmbeddings hashes text into vectors.
+"""
+import asyncio
+import hashlib
+import json
+import time
+import types
+from typing import List
+
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+
+
+class FakeChatClient:
+    def __init__(self, first_token_s: float = 0.0, token_s: float = 0.0, response_tokens: int = 50):
+        self.first_token_s = first_token_s
+        self.token_s = token_s
+        self.response_tokens = response_tokens
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+        self.calls = 0
+
+    async def close(self):
+        pass
+
+    async def _create(self, model: str, messages: List[dict], stream: bool = False, **kwargs):
+        self.calls += 1
+        pieces = self._answer(messages)
+        if stream:
+            return self._stream(pieces)
+        await asyncio.sleep(self.first_token_s + self.token_s * len(pieces))
+        message = types.SimpleNamespace(content="".join(pieces))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    async def _stream(self, pieces: List[str]):
+        await asyncio.sleep(self.first_token_s)
+        for piece in pieces:
+            if self.token_s:
+                await asyncio.sleep(self.token_s)
+            delta = types.SimpleNamespace(content=piece)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+    def _answer(self, messages: List[dict]) -> List[str]:
+        prompt = messages[-1]["content"]
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        if "JSON" in messages[0]["content"]:
+            return [json.dumps({"grade": int(digest[:2], 16) % 101, "feedback": "Deterministic feedback."})]
+        return [f"{digest[i % 64]}word " for i in range(self.response_tokens)]
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embeddings with a fixed delay per request, as if each call were one API round trip."""
+
+    def __init__(self, size: int = 768, latency_s: float = 0.0):
+        self._embeddings = DeterministicFakeEmbedding(size=size)
+        self.latency_s = latency_s
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency_s)
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency_s)
+        return self._embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self.latency_s)
+        return self._embeddings.embed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self.latency_s)
+        return self._embeddings.embed_query(text)
@@ -0,0 +1,233 @@
+"""
+An in-memory stand-in for google.cloud.firestore with injectable latency.
+
+Only the calls database.py makes are implemented. `install(client)` points database.py's
+`firestore` module reference at this fake, so its Increment/SERVER_TIMESTAMP sentinels,
+Query directions and @transactional decorator resolve to the fake versions. Transactions
+run under one client-wide lock, which is stricter than Firestore but gives the same results.
+"""
+import itertools
+import threading
+import time
+import types
+import uuid
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+import database
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+SERVER_TIMESTAMP = object()
+
+
+class Query:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+
+def transactional(func):
+    def run(transaction, *args, **kwargs):
+        with transaction.client._transaction_lock:
+            return func(transaction, *args, **kwargs)
+    return run
+
+
+def install(client: "FakeFirestoreClient"):
+    """Makes database.py use the fake module for sentinels and transactions, and returns the client."""
+    database.firestore = types.SimpleNamespace(
+        Client=FakeFirestoreClient, Increment=Increment, SERVER_TIMESTAMP=SERVER_TIMESTAMP,
+        Query=Query, transactional=transactional,
+    )
+    return client
+
+
+class FakeFirestoreClient:
+    def __init__(self, latency_s: float = 0.0):
+        self.latency_s = latency_s
+        self._docs = {}  # document path -> dict
+        self._lock = threading.Lock()
+        self._transaction_lock = threading.RLock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def get_all(self, refs):
+        self._simulate_round_trip()
+        return [ref._snapshot() for ref in refs]
+
+    def _simulate_round_trip(self):
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def _write(self, path, data, merge=False, must_exist=False, must_not_exist=False):
+        with self._lock:
+            if must_exist and path not in self._docs:
+                raise NotFound(path)
+            if must_not_exist and path in self._docs:
+                raise AlreadyExists(path)
+            current = dict(self._docs.get(path, {})) if (merge or must_exist) else {}
+            for key, value in data.items():
+                if isinstance(value, Increment):
+                    current[key] = current.get(key, 0) + value.value
+                elif value is SERVER_TIMESTAMP:
+                    current[key] = datetime.now(timezone.utc)
+                else:
+                    current[key] = value
+            self._docs[path] = current
+
+
+class FakeCollection:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+
+    def document(self, doc_id=None):
+        return FakeDocumentRef(self.client, f"{self.path}/{doc_id or uuid.uuid4().hex}")
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+    def where(self, field, op, value):
+        return FakeQuery(self).where(field, op, value)
+
+    def order_by(self, field, direction=Query.ASCENDING):
+        return FakeQuery(self).order_by(field, direction)
+
+    def limit(self, count):
+        return FakeQuery(self).limit(count)
+
+    def stream(self, transaction=None):
+        return FakeQuery(self).stream(transaction)
+
+
+class FakeDocumentRef:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[1]
+
+    def collection(self, name):
+        return FakeCollection(self.client, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        self.client._simulate_round_trip()
+        return self._snapshot()
+
+    def set(self, data, merge=False):
+        self.client._simulate_round_trip()
+        self.client._write(self.path, data, merge=merge)
+
+    def create(self, data):
+        self.client._simulate_round_trip()
+        self.client._write(self.path, data, must_not_exist=True)
+
+    def update(self, data):
+        self.client._simulate_round_trip()
+        self.client._write(self.path, data, must_exist=True)
+
+    def delete(self):
+        self.client._simulate_round_trip()
+        with self.client._lock:
+            self.client._docs.pop(self.path, None)
+
+    def _snapshot(self):
+        with self.client._lock:
+            data = self.client._docs.get(self.path)
+        return FakeSnapshot(self.id, dict(data) if data is not None else None)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return self._data.get(field) if self._data else None
+
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+}
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), order=None, count=None):
+        self.collection = collection
+        self.filters = list(filters)
+        self.order = order
+        self.count = count
+
+    def where(self, field, op, value):
+        return FakeQuery(self.collection, self.filters + [(field, op, value)], self.order, self.count)
+
+    def order_by(self, field, direction=Query.ASCENDING):
+        return FakeQuery(self.collection, self.filters, (field, direction), self.count)
+
+    def limit(self, count):
+        return FakeQuery(self.collection, self.filters, self.order, count)
+
+    def stream(self, transaction=None):
+        client = self.collection.client
+        client._simulate_round_trip()
+        prefix = self.collection.path + "/"
+        with client._lock:
+            matches = [
+                FakeSnapshot(path[len(prefix):], dict(data)) for path, data in client._docs.items()
+                if path.startswith(prefix) and "/" not in path[len(prefix):]
+                and all(_OPERATORS[op](data.get(field), value) for field, op, value in self.filters)
+            ]
+        if self.order:
+            field, direction = self.order
+            matches.sort(key=lambda snapshot: snapshot.get(field), reverse=direction == Query.DESCENDING)
+        return iter(matches[:self.count] if self.count is not None else matches)
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self._writes = []
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref.path, data, merge))
+
+    def commit(self):
+        self.client._simulate_round_trip()
+        for path, data, merge in self._writes:
+            self.client._write(path, data, merge=merge)
+
+
+class FakeTransaction:
+    _ids = itertools.count(1)
+
+    def __init__(self, client):
+        self.client = client
+        self.id = next(self._ids)
+
+    def set(self, ref, data, merge=False):
+        self.client._write(ref.path, data, merge=merge)
+
+    def update(self, ref, data):
+        self.client._write(ref.path, data, must_exist=True)
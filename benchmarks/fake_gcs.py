@@ -0,0 +1,93 @@
+"""
+An in-memory stand-in for google.cloud.storage.Client with injectable latency.
+
+Only the calls the backend makes are implemented. Latency and bandwidth are
+simulated with sleeps, which release the GIL the same way real network I/O does.
+"""
+import itertools
+import threading
+import time
+
+
+class FakeStorageClient:
+    def __init__(self, latency_s: float = 0.0, bandwidth_mb_s: float = 0.0):
+        self.latency_s = latency_s
+        self.bandwidth_mb_s = bandwidth_mb_s
+        self._objects = {}  # (bucket_name, blob_name) -> (data, generation)
+        self._generations = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self, bucket_name)
+
+    def list_blobs(self, bucket_or_name, prefix=""):
+        bucket_name = getattr(bucket_or_name, "name", bucket_or_name)
+        self._simulate_transfer(0)
+        with self._lock:
+            names = sorted(name for (b, name) in self._objects if b == bucket_name and name.startswith(prefix))
+        return [FakeBlob(self, bucket_name, name) for name in names]
+
+    def _simulate_transfer(self, num_bytes):
+        delay = self.latency_s
+        if self.bandwidth_mb_s:
+            delay += num_bytes / (self.bandwidth_mb_s * 1024 * 1024)
+        if delay:
+            time.sleep(delay)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, blob_name):
+        return FakeBlob(self.client, self.name, blob_name)
+
+
+class FakeBlob:
+    def __init__(self, client, bucket_name, name):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.name = name
+
+    @property
+    def _key(self):
+        return (self.bucket_name, self.name)
+
+    @property
+    def size(self):
+        with self.client._lock:
+            entry = self.client._objects.get(self._key)
+        return len(entry[0]) if entry else None
+
+    @property
+    def generation(self):
+        with self.client._lock:
+            entry = self.client._objects.get(self._key)
+        return entry[1] if entry else None
+
+    def upload_from_string(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.client._simulate_transfer(len(data))
+        with self.client._lock:
+            self.client._objects[self._key] = (bytes(data), next(self.client._generations))
+
+    def upload_from_filename(self, filename):
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read())
+
+    def download_as_bytes(self):
+        with self.client._lock:
+            data = self.client._objects[self._key][0]
+        self.client._simulate_transfer(len(data))
+        return data
+
+    def download_to_filename(self, filename):
+        with open(filename, "wb") as f:
+            f.write(self.download_as_bytes())
+
+    def delete(self):
+        self.client._simulate_transfer(0)
+        with self.client._lock:
+            self.client._objects.pop(self._key, None)
@@ -0,0 +1,67 @@
+"""
+Measures vector store save/load throughput against the fake GCS client.
+
+Usage (from the repository root):
+    python -m benchmarks.gcs_transfer_benchmark --chunks 5000 --latency-ms 40 --bandwidth-mb-s 50
+"""
+import argparse
+import time
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+import gcs_transfer
+import rag
+from benchmarks.fake_gcs import FakeStorageClient
+
+BUCKET = "benchmark-bucket"
+
+
+def build_vector_store(num_chunks: int, dim: int):
+    embeddings = DeterministicFakeEmbedding(size=dim)
+    docs = [Document(page_content=f"chunk {i} " + "lorem ipsum " * 80) for i in range(num_chunks)]
+    return FAISS.from_documents(docs, embeddings), embeddings
+
+
+def timed(func, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--bandwidth-mb-s", type=float, default=50.0)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    gcs_transfer.set_storage_client(
+        FakeStorageClient(latency_s=args.latency_ms / 1000, bandwidth_mb_s=args.bandwidth_mb_s)
+    )
+    vector_store, embeddings = build_vector_store(args.chunks, args.dim)
+    prefix = "vector_stores/benchmark/doc"
+    files = rag.serialize_vector_store(vector_store)
+    total_mb = sum(len(data) for data in files.values()) / (1024 * 1024)
+    print(f"Index: {args.chunks} chunks, {total_mb:.2f} MB across {len(files)} files")
+
+    for workers in (1, gcs_transfer.TRANSFER_WORKERS):
+        upload_s = timed(lambda: gcs_transfer.upload_bytes(BUCKET, prefix, files, max_workers=workers), args.repeats)
+        blobs = gcs_transfer.list_blobs(BUCKET, prefix)
+        download_s = timed(lambda: gcs_transfer.download_bytes(blobs, max_workers=workers), args.repeats)
+        print(
+            f"workers={workers:<3} upload {upload_s * 1000:8.1f} ms ({total_mb / upload_s:7.1f} MB/s)  "
+            f"download {download_s * 1000:8.1f} ms ({total_mb / download_s:7.1f} MB/s)"
+        )
+
+    save_s = timed(lambda: rag.save_vector_store_to_gcs(vector_store, BUCKET, prefix), args.repeats)
+    load_s = timed(lambda: rag.load_vector_store_from_gcs(BUCKET, prefix, embeddings), args.repeats)
+    print(f"end-to-end save {save_s * 1000:.1f} ms, load {load_s * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
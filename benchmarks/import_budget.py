@@ -0,0 +1,81 @@
+"""
+Checks what importing the backend costs, so slow imports do not creep back into cold starts.
+
+Imports a module in a fresh interpreter with `python -X importtime`, then reports the slowest
+top-level packages by their own import time and the slowest modules overall. It exits
+non-zero if the import takes longer than the budget or pulls in a package that should only
+be loaded on first use (provider SDKs, FAISS, PDF parsing, text splitting).
+
+Usage (from the repository root):
+    python -m benchmarks.import_budget
+    python -m benchmarks.import_budget --module llm_config --budget-ms 50
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+# Imported on first use by ai.py, rag.py, ingestion.py and pdf_parsing.py. langchain_core loads the
+# langchain_text_splitters package itself, so the check is on the splitter module rag.py imports.
+DEFERRED_PACKAGES = (
+    "together", "openai", "google.generativeai", "langchain_together",
+    "faiss", "langchain_community.vectorstores.faiss", "langchain_text_splitters.character", "pypdf",
+)
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(module: str):
+    """Returns [(module, self_us, cumulative_us, depth)] in import order for a cold import of `module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-W", "ignore", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.getcwd(),
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return rows
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=2000.0, help="maximum cumulative import time")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = measure(args.module)
+    total_ms = next((cumulative for name, _, cumulative, _ in rows if name == args.module), 0) / 1000
+    by_package = defaultdict(int)
+    for name, self_us, _, _ in rows:
+        by_package[name.split(".")[0]] += self_us
+
+    print(f"import {args.module}: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms), {len(rows)} modules")
+    print(f"\n{'package':<40} {'self ms':>9}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<40} {self_us / 1000:>9.1f}")
+    print(f"\n{'module':<60} {'cumulative ms':>14}")
+    for name, _, cumulative_us, _ in sorted(rows, key=lambda row: -row[2])[:args.top]:
+        print(f"{name:<60} {cumulative_us / 1000:>14.1f}")
+
+    imported = {name for name, _, _, _ in rows}
+    eager = [package for package in DEFERRED_PACKAGES if package in imported]
+    failed = False
+    if eager:
+        print(f"\nFAIL: imported at startup but meant to load on first use: {', '.join(eager)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print(f"\nFAIL: import took {total_ms:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,83 @@
+"""
+Measures logins per second through POST /token on one backend worker, with Firestore faked.
+
+Alongside throughput and latency it samples event loop lag, which stays near zero while
+bcrypt runs in the hashing pool, and counts the 503s returned once the pool's queue is full.
+
+Usage (from the repository root):
+    python -m benchmarks.login_benchmark --rounds 12 --concurrency 32 --duration 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import auth
+import database
+import main
+
+PASSWORD = "correct horse battery staple"
+
+
+async def measure_loop_lag(stop: asyncio.Event, samples: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        samples.append(time.perf_counter() - start - 0.01)
+
+
+async def run(args):
+    auth.BCRYPT_ROUNDS = args.rounds
+    users = {f"user{i}": {"role": "student", "school_id": None, "hashed_password": auth.get_password_hash(PASSWORD)}
+             for i in range(args.concurrency)}
+    database.get_user = lambda db, username: users.get(username)
+
+    main.app.state.db = None
+    main.app.state.io_executor = ThreadPoolExecutor(max_workers=16)
+    main.app.state.password_hasher = auth.PasswordHasher(max_workers=args.workers, max_queue=args.max_queue)
+
+    latencies, statuses, lag = [], {}, []
+    stop = asyncio.Event()
+    deadline = time.perf_counter() + args.duration
+
+    async def client_loop(client: httpx.AsyncClient, username: str):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = await client.post("/token", data={"username": username, "password": PASSWORD})
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        lag_task = asyncio.create_task(measure_loop_lag(stop, lag))
+        started = time.perf_counter()
+        await asyncio.gather(*(client_loop(client, username) for username in users))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await lag_task
+
+    main.app.state.password_hasher.shutdown()
+    main.app.state.io_executor.shutdown()
+    ok = statuses.get(200, 0)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    print(f"rounds={args.rounds} hash workers={args.workers} queue={args.max_queue} concurrency={args.concurrency}")
+    print(f"logins/s: {ok / elapsed:.1f}  statuses: {dict(sorted(statuses.items()))}")
+    print(f"latency p50 {quantiles[49] * 1000:.1f} ms  p95 {quantiles[94] * 1000:.1f} ms  p99 {quantiles[98] * 1000:.1f} ms")
+    print(f"event loop lag max {max(lag, default=0) * 1000:.1f} ms  mean {statistics.fmean(lag or [0]) * 1000:.2f} ms")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=auth.BCRYPT_ROUNDS)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main_cli()
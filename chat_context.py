@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import tiktoken
+
+# --- Configuration ---
+# Share of a provider's context budget that retrieved document chunks may use.
+RAG_BUDGET_FRACTION = float(os.getenv("CHAT_RAG_BUDGET_FRACTION", 0.3))
+# Chunks retrieved per question before the budget decides how many are sent.
+RAG_CANDIDATE_CHUNKS = int(os.getenv("CHAT_RAG_CANDIDATE_CHUNKS", 6))
+# Once unsummarized history exceeds this share of the budget, older turns are folded into the summary.
+SUMMARY_TRIGGER_FRACTION = float(os.getenv("CHAT_SUMMARY_TRIGGER_FRACTION", 0.5))
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Role markers and separators added per message by chat templates
+
+
+# Encodings loaded so far, by model. tiktoken downloads its vocabularies on first use, so they are
+# loaded at startup by preload_encodings() or in a background thread, never on the event loop.
+# Failures are not cached: a model without an encoding is estimated and retried after a while.
+_encodings: Dict[str, object] = {}
+_load_attempts: Dict[str, float] = {}
+_load_lock = threading.Lock()
+ENCODING_RETRY_S = 60.0
+
+
+def load_encoding(model: str):
+    """Loads (downloading if needed) the encoding for `model`. Blocking; returns None on failure."""
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Non-OpenAI models (Llama, Gemini) use similar-sized vocabularies; cl100k is a close estimate.
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"No tokenizer available for {model}, estimating token counts: {e}")
+        return None
+    _encodings[model] = encoding
+    return encoding
+
+
+def preload_encodings(models):
+    """Loads the encodings for `models` ahead of the first chat turn."""
+    for model in models:
+        with _load_lock:
+            _load_attempts[model] = time.monotonic()
+        load_encoding(model)
+
+
+def _get_encoding(model: str):
+    encoding = _encodings.get(model)
+    if encoding is None:
+        with _load_lock:
+            last_attempt = _load_attempts.get(model)
+            retry = last_attempt is None or time.monotonic() - last_attempt >= ENCODING_RETRY_S
+            if retry:
+                _load_attempts[model] = time.monotonic()
+        if retry:
+            threading.Thread(target=load_encoding, args=(model,), daemon=True).start()
+    return encoding
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Counts the tokens of `text` for `model`, falling back to a character estimate if no tokenizer is available."""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict], model: str) -> int:
+    return sum(count_tokens(m["content"], model) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def fit_history(messages: List[Dict], budget_tokens: int, model: str) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Splits history into (dropped, kept): the newest messages that fit in `budget_tokens` are kept.
+    The kept part never starts with an assistant turn, so it always opens with a question.
+    """
+    used, start = 0, len(messages)
+    while start > 0:
+        cost = count_tokens(messages[start - 1]["content"], model) + MESSAGE_OVERHEAD_TOKENS
+        if used + cost > budget_tokens:
+            break
+        used += cost
+        start -= 1
+    while start < len(messages) and messages[start]["role"] == "assistant":
+        start += 1
+    return messages[:start], messages[start:]
+
+
+def fit_chunks(chunks: List[str], budget_tokens: int, model: str) -> List[str]:
+    """Returns the leading (most relevant) chunks that fit in `budget_tokens`."""
+    fitted, used = [], 0
+    for chunk in chunks:
+        cost = count_tokens(chunk, model)
+        if used + cost > budget_tokens:
+            break
+        fitted.append(chunk)
+        used += cost
+    return fitted
+
+
+def with_summary(system_prompt: str, summary: Optional[str]) -> str:
+    """Appends the rolling summary of earlier turns to the system prompt."""
+    if not summary:
+        return system_prompt
+    return f"{system_prompt}\n\nSummary of the earlier conversation:\n{summary}"
+
+
+def build_summary_prompt(previous_summary: Optional[str], messages: List[Dict]) -> str:
+    """Asks the model to fold older turns into the running summary."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    return f"""
+    Update the summary of a tutoring conversation with the new turns below.
+    Keep the facts, definitions, the student's goals and anything they struggled with; drop pleasantries.
+    Reply with the updated summary only, in at most 200 words.
+
+    Current summary:
+    ---
+    {previous_summary or "(none)"}
+    ---
+
+    New turns:
+    ---
+    {transcript}
+    ---
+    """
@@ -1,7 +1,9 @@
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import firestore
 import json
+import time
 import uuid
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import auth
 
 # --- Firestore Initialization ---
@@ -35,6 +37,24 @@ def get_or_create_user(db: firestore.Client, username: str, role: str, password:
             })
         return user_data
 
+def create_user(db: firestore.Client, username: str, hashed_password: str, role: str) -> Optional[Dict]:
+    """Creates a user from an already-hashed password. Returns None if the username is taken."""
+    user_data = {"role": role, "school_id": None, "hashed_password": hashed_password}
+    try:
+        db.collection("users").document(username).create(user_data)
+    except AlreadyExists:
+        return None
+    if role == "Educator":
+        db.collection("classrooms").document(username).set({
+            "student_ids": [],
+            "pending_student_ids": [],
+            "join_code": str(uuid.uuid4())
+        })
+    return {"username": username, "role": role, "school_id": None}
+
+def update_password_hash(db: firestore.Client, username: str, hashed_password: str):
+    db.collection("users").document(username).update({"hashed_password": hashed_password})
+
 def create_school(db: firestore.Client, school_name: str) -> Dict:
     # ... (code is correct)
     pass
@@ -57,12 +77,30 @@ def approve_student_join_request(db: firestore.Client, educator_username: str, s
     pass
 
 # --- RAG Document Management ---
-def add_document_metadata(db: firestore.Client, owner_id: str, gcs_path: str, category: str, filename: str, doc_id: str):
+def add_document_metadata(db: firestore.Client, owner_id: str, gcs_path: str, category: str, filename: str, doc_id: str,
+                          index_stats: Optional[Dict] = None):
+    """`index_stats` records the vector index format, size and recall chosen at ingestion."""
     doc_data = {"owner_id": owner_id, "gcs_path": gcs_path, "category": category, "filename": filename}
+    if index_stats:
+        doc_data["index"] = index_stats
     db.collection("documents").document(doc_id).set(doc_data)
 
-def get_documents_for_user(db: firestore.Client, owner_id: str) -> List[Dict]:
-    docs_query = db.collection("documents").where("owner_id", "==", owner_id).stream()
+def delete_document_metadata(db: firestore.Client, doc_id: str):
+    db.collection("documents").document(doc_id).delete()
+
+def get_document(db: firestore.Client, doc_id: str) -> Optional[Dict]:
+    doc = db.collection("documents").document(doc_id).get()
+    if doc.exists:
+        data = doc.to_dict()
+        data["id"] = doc.id
+        return data
+    return None
+
+def get_documents_for_user(db: firestore.Client, owner_id: str, category: Optional[str] = None) -> List[Dict]:
+    docs_query = db.collection("documents").where("owner_id", "==", owner_id)
+    if category is not None:
+        docs_query = docs_query.where("category", "==", category)
+    docs_query = docs_query.stream()
     documents = []
     for doc in docs_query:
         doc_data = doc.to_dict()
@@ -70,12 +108,236 @@ def get_documents_for_user(db: firestore.Client, owner_id: str) -> List[Dict]:
         documents.append(doc_data)
     return documents
 
+# --- Storage Accounting ---
+# Each user has a `storage_usage/{username}` counter document. `used_bytes` is what is stored
+# in GCS; `reserved_bytes` covers uploads that passed the quota check but are still processing,
+# and `pending_deletes` counts deletions still removing blobs. Every change to `used_bytes` bumps
+# `usage_version`, so reconciliation can tell whether a counter moved while it listed the bucket.
+# Reservations younger than this are left alone by reconciliation: their upload may still be creating its job.
+RESERVATION_GRACE_S = 600
+
+def get_storage_usage_bytes(db: firestore.Client, username: str) -> int:
+    """Returns the committed storage usage for a user, in bytes."""
+    doc = db.collection("storage_usage").document(username).get()
+    return int(doc.to_dict().get("used_bytes", 0)) if doc.exists else 0
+
+def reserve_storage(db: firestore.Client, username: str, num_bytes: int, limit_bytes: int) -> bool:
+    """
+    Atomically reserves `num_bytes` against the user's quota.
+    Returns False, without reserving anything, if the reservation would exceed `limit_bytes`.
+    """
+    usage_ref = db.collection("storage_usage").document(username)
+
+    @firestore.transactional
+    def reserve_in_transaction(transaction):
+        snapshot = usage_ref.get(transaction=transaction)
+        usage = snapshot.to_dict() if snapshot.exists else {}
+        used = usage.get("used_bytes", 0) + usage.get("reserved_bytes", 0)
+        if used + num_bytes > limit_bytes:
+            return False
+        transaction.set(usage_ref, {
+            "reserved_bytes": usage.get("reserved_bytes", 0) + num_bytes,
+            "reserved_at": time.time(),
+        }, merge=True)
+        return True
+
+    return reserve_in_transaction(db.transaction())
+
+def commit_storage_reservation(db: firestore.Client, username: str, reserved_bytes: int, stored_bytes: int):
+    """Turns a reservation into committed usage, charged at the size actually stored."""
+    db.collection("storage_usage").document(username).set({
+        "reserved_bytes": firestore.Increment(-reserved_bytes),
+        "used_bytes": firestore.Increment(stored_bytes),
+        "usage_version": firestore.Increment(1),
+    }, merge=True)
+
+def release_storage_reservation(db: firestore.Client, username: str, reserved_bytes: int):
+    """Cancels a reservation for an upload that failed."""
+    db.collection("storage_usage").document(username).set({
+        "reserved_bytes": firestore.Increment(-reserved_bytes),
+    }, merge=True)
+
+def begin_storage_release(db: firestore.Client, username: str):
+    """Marks a deletion in progress, so reconciliation leaves the user alone until release_storage."""
+    db.collection("storage_usage").document(username).set({
+        "pending_deletes": firestore.Increment(1),
+        "usage_version": firestore.Increment(1),
+    }, merge=True)
+
+def release_storage(db: firestore.Client, username: str, freed_bytes: int):
+    """Subtracts the size of deleted files from a user's committed usage and ends the deletion."""
+    db.collection("storage_usage").document(username).set({
+        "used_bytes": firestore.Increment(-freed_bytes),
+        "pending_deletes": firestore.Increment(-1),
+        "usage_version": firestore.Increment(1),
+    }, merge=True)
+
+def get_storage_usage_snapshot(db: firestore.Client) -> Dict[str, Dict]:
+    """Returns every user's usage counters. Read before listing the bucket, to fence reconciliation."""
+    return {doc.id: doc.to_dict() for doc in db.collection("storage_usage").stream()}
+
+def reconcile_user_storage_usage(db: firestore.Client, username: str, snapshot: Optional[Dict], actual_bytes: int) -> bool:
+    """
+    Repairs one user's counters in a transaction. `reserved_bytes` is recomputed from the user's
+    unfinished ingestion jobs, which releases reservations leaked by a request that died before
+    creating its job. `used_bytes` is overwritten with the size found in the bucket, but only if
+    no job or deletion is in flight and the counter has not changed since `snapshot` (the counter
+    document read before the bucket was listed); otherwise the listing may miss or double-count bytes.
+    Returns False if anything was left for a later round.
+    """
+    usage_ref = db.collection("storage_usage").document(username)
+    jobs_query = (db.collection("ingestion_jobs")
+                  .where("owner_id", "==", username).where("status", "in", ["queued", "running"]))
+    expected_version = (snapshot or {}).get("usage_version", 0)
+
+    @firestore.transactional
+    def reconcile_in_transaction(transaction):
+        current = usage_ref.get(transaction=transaction)
+        usage = current.to_dict() if current.exists else {}
+        jobs = [job.to_dict() for job in jobs_query.stream(transaction=transaction)]
+        fields = {}
+
+        # A reservation younger than the grace period may belong to an upload still creating its job.
+        reserved_bytes = sum(job.get("reserved_bytes", 0) for job in jobs)
+        recently_reserved = time.time() - usage.get("reserved_at", 0) < RESERVATION_GRACE_S
+        if usage.get("reserved_bytes", 0) != reserved_bytes and not recently_reserved:
+            fields["reserved_bytes"] = reserved_bytes
+        settled = not jobs and not recently_reserved and usage.get("pending_deletes", 0) <= 0
+        settled = settled and usage.get("usage_version", 0) == expected_version
+        if settled and usage.get("used_bytes", 0) != actual_bytes:
+            fields.update({"used_bytes": actual_bytes, "usage_version": expected_version + 1})
+        if fields:
+            transaction.set(usage_ref, fields, merge=True)
+        return settled
+
+    return reconcile_in_transaction(db.transaction())
+
+def reconcile_storage_usage(db: firestore.Client, snapshot: Dict[str, Dict], actual_usage_bytes: Dict[str, int]) -> Tuple[int, int]:
+    """
+    Reconciles every user found in the snapshot or the bucket, one transaction each.
+    Users with a counter but no remaining blobs are reset to zero. Returns (reconciled, skipped)
+    user counts, where skipped users had uploads or deletions in flight.
+    """
+    reconciled = skipped = 0
+    for username in set(actual_usage_bytes) | set(snapshot):
+        if reconcile_user_storage_usage(db, username, snapshot.get(username), actual_usage_bytes.get(username, 0)):
+            reconciled += 1
+        else:
+            skipped += 1
+    return reconciled, skipped
+
+# --- Leases ---
+# `leases/{name}` lets one instance out of many run a periodic job: whoever holds an unexpired lease runs it.
+def try_acquire_lease(db: firestore.Client, name: str, holder: str, now: float, lease_s: float) -> bool:
+    """Takes the named lease until `now + lease_s` if it is free, expired or already ours."""
+    lease_ref = db.collection("leases").document(name)
+
+    @firestore.transactional
+    def acquire_in_transaction(transaction):
+        snapshot = lease_ref.get(transaction=transaction)
+        lease = snapshot.to_dict() if snapshot.exists else {}
+        if lease.get("holder") not in (None, holder) and lease.get("expires_at", 0) > now:
+            return False
+        transaction.set(lease_ref, {"holder": holder, "expires_at": now + lease_s})
+        return True
+
+    return acquire_in_transaction(db.transaction())
+
+# --- Ingestion Jobs ---
+# `ingestion_jobs/{job_id}` tracks a document upload through parsing, embedding and saving.
+# A worker owns a job while its `lease_expires_at` (epoch seconds) is in the future.
+def create_ingestion_job(db: firestore.Client, job_id: str, job_data: Dict):
+    db.collection("ingestion_jobs").document(job_id).set(job_data)
+
+def get_ingestion_job(db: firestore.Client, job_id: str) -> Optional[Dict]:
+    doc = db.collection("ingestion_jobs").document(job_id).get()
+    if doc.exists:
+        data = doc.to_dict()
+        data["id"] = doc.id
+        return data
+    return None
+
+def update_ingestion_job(db: firestore.Client, job_id: str, fields: Dict):
+    db.collection("ingestion_jobs").document(job_id).update(fields)
+
+def claim_ingestion_job(db: firestore.Client, job_id: str, worker_id: str, now: float, lease_s: float) -> Optional[Dict]:
+    """
+    Atomically takes ownership of a queued job, or of a running job whose lease has expired.
+    Returns the job data, or None if the job is finished or owned by a live worker.
+    """
+    job_ref = db.collection("ingestion_jobs").document(job_id)
+
+    @firestore.transactional
+    def claim_in_transaction(transaction):
+        snapshot = job_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        job = snapshot.to_dict()
+        if job["status"] not in ("queued", "running"):
+            return None
+        if job["status"] == "running" and job.get("lease_expires_at", 0) > now:
+            return None
+        claim = {"status": "running", "worker_id": worker_id, "lease_expires_at": now + lease_s,
+                 "attempts": job.get("attempts", 0) + 1}
+        transaction.update(job_ref, claim)
+        job.update(claim)
+        return job
+
+    return claim_in_transaction(db.transaction())
+
+def get_unfinished_ingestion_job_ids(db: firestore.Client, now: float) -> List[str]:
+    """Returns jobs that are waiting to run or whose worker stopped renewing its lease."""
+    jobs_query = db.collection("ingestion_jobs").where("status", "in", ["queued", "running"]).stream()
+    return [
+        job.id for job in jobs_query
+        if job.get("status") == "queued" or job.get("lease_expires_at") <= now
+    ]
+
+def finish_ingestion_job(db: firestore.Client, job_id: str, worker_id: str, job_fields: Dict, usage_fields: Dict) -> bool:
+    """
+    Applies the final job update and the matching storage counter change in one transaction.
+    Does nothing, and returns False, if another worker has taken the job over in the meantime.
+    """
+    job_ref = db.collection("ingestion_jobs").document(job_id)
+
+    @firestore.transactional
+    def finish_in_transaction(transaction):
+        job = job_ref.get(transaction=transaction).to_dict()
+        if job["status"] != "running" or job.get("worker_id") != worker_id:
+            return False
+        transaction.update(job_ref, {**job_fields, "completed_at": firestore.SERVER_TIMESTAMP})
+        transaction.set(db.collection("storage_usage").document(job["owner_id"]), usage_fields, merge=True)
+        return True
+
+    return finish_in_transaction(db.transaction())
+
+def complete_ingestion_job(db: firestore.Client, job_id: str, worker_id: str, reserved_bytes: int, stored_bytes: int) -> bool:
+    """Marks a job completed and commits its storage reservation at the stored size."""
+    return finish_ingestion_job(
+        db, job_id, worker_id,
+        {"status": "completed", "stage": "completed", "progress": 1.0},
+        {"reserved_bytes": firestore.Increment(-reserved_bytes), "used_bytes": firestore.Increment(stored_bytes),
+         "usage_version": firestore.Increment(1)},
+    )
+
+def fail_ingestion_job(db: firestore.Client, job_id: str, worker_id: str, reserved_bytes: int, error: str) -> bool:
+    """Marks a job failed and releases its storage reservation."""
+    return finish_ingestion_job(
+        db, job_id, worker_id,
+        {"status": "failed", "error": error},
+        {"reserved_bytes": firestore.Increment(-reserved_bytes)},
+    )
+
 # --- Assignment & Attendance ---
-def create_assignment(db: firestore.Client, educator_id: str, title: str, description: str, due_date) -> str:
-    """Creates a new assignment, gets its ID, and then assigns it to the class."""
+def create_assignment(db: firestore.Client, educator_id: str, title: str, description: str, due_date, assign: bool = True) -> str:
+    """
+    Creates a new assignment, gets its ID, and then assigns it to the class.
+    Pass assign=False to fan it out to the class separately (e.g. in the background for large rosters).
+    """
     assignment_data = {"educator_id": educator_id, "title": title, "description": description, "due_date": due_date}
     _, assignment_ref = db.collection("assignments").add(assignment_data)
-    assign_to_class(db, educator_id, assignment_ref.id) # Assign to current students
+    if assign:
+        assign_to_class(db, educator_id, assignment_ref.id) # Assign to current students
     return assignment_ref.id
 
 def get_assignments_for_educator(db: firestore.Client, educator_id: str) -> List[Dict]:
@@ -87,15 +349,33 @@ def get_assignments_for_educator(db: firestore.Client, educator_id: str) -> List
         assignments.append(assignment_data)
     return assignments
 
+def get_students_for_educator(db: firestore.Client, educator_id: str) -> List[str]:
+    """Returns the usernames on an educator's class roster (classrooms/{educator}.student_ids)."""
+    classroom = db.collection("classrooms").document(educator_id).get()
+    if not classroom.exists:
+        return []
+    return list(classroom.to_dict().get("student_ids") or [])
+
 def assign_to_class(db: firestore.Client, educator_id: str, assignment_id: str):
     """Assigns an assignment to all students in an educator's class."""
     students = get_students_for_educator(db, educator_id)
-    for student_id in students:
-        db.collection("student_assignments").add({
-            "student_id": student_id,
-            "assignment_id": assignment_id,
-            "status": "assigned"
-        })
+    assign_to_students(db, assignment_id, students)
+
+def assign_to_students(db: firestore.Client, assignment_id: str, student_ids: List[str]):
+    """
+    Creates the student_assignments mappings with batched writes of up to 500.
+    Mapping IDs are derived from the assignment and student, so re-running after a partial failure
+    does not create duplicates.
+    """
+    for i in range(0, len(student_ids), 500):
+        batch = db.batch()
+        for student_id in student_ids[i:i + 500]:
+            batch.set(db.collection("student_assignments").document(f"{assignment_id}_{student_id}"), {
+                "student_id": student_id,
+                "assignment_id": assignment_id,
+                "status": "assigned"
+            })
+        batch.commit()
 
 def get_assignments_for_student(db: firestore.Client, student_username: str) -> List[Dict]:
     """Retrieves all assignments for a student via the mapping collection."""
@@ -105,12 +385,8 @@ def get_assignments_for_student(db: firestore.Client, student_username: str) ->
     if not assignment_ids:
         return []
 
-    assignments = []
-    for assignment_id in assignment_ids:
-        assignment = get_assignment(db, assignment_id)
-        if assignment:
-            assignments.append(assignment)
-    return assignments
+    assignments = get_assignments(db, assignment_ids)
+    return [assignments[assignment_id] for assignment_id in assignment_ids if assignment_id in assignments]
 
 def get_assignment(db: firestore.Client, assignment_id: str) -> Optional[Dict]:
     """Retrieves a single assignment by its ID."""
@@ -122,6 +398,23 @@ def get_assignment(db: firestore.Client, assignment_id: str) -> Optional[Dict]:
         return data
     return None
 
+def get_assignments(db: firestore.Client, assignment_ids: List[str]) -> Dict[str, Dict]:
+    """
+    Retrieves many assignments with batched multi-gets instead of one read per ID.
+    Returns {assignment_id: assignment}; IDs that do not exist are left out.
+    """
+    unique_ids = list(dict.fromkeys(assignment_ids))
+    assignments = {}
+    # Keep each multi-get to a modest number of documents.
+    for i in range(0, len(unique_ids), 100):
+        refs = [db.collection("assignments").document(assignment_id) for assignment_id in unique_ids[i:i + 100]]
+        for doc in db.get_all(refs):
+            if doc.exists:
+                data = doc.to_dict()
+                data["id"] = doc.id
+                assignments[doc.id] = data
+    return assignments
+
 def save_submission(db: firestore.Client, assignment_id: str, student_id: str, content: str, grade: int, feedback: str):
     """Saves a student's submission, grade, and feedback."""
     submission_data = {
@@ -134,21 +427,96 @@ def save_submission(db: firestore.Client, assignment_id: str, student_id: str, c
     }
     db.collection("submissions").add(submission_data)
 
+def save_submissions(db: firestore.Client, submissions: List[Dict]):
+    """
+    Saves many graded submissions (dicts with assignment_id, student_id, content, grade and feedback)
+    using batched writes, within Firestore's limit of 500 writes per batch.
+    """
+    for i in range(0, len(submissions), 500):
+        batch = db.batch()
+        for submission in submissions[i:i + 500]:
+            batch.set(db.collection("submissions").document(), {
+                "assignment_id": submission["assignment_id"],
+                "student_id": submission["student_id"],
+                "content": submission["content"],
+                "grade": submission["grade"],
+                "feedback": submission["feedback"],
+                "submitted_at": firestore.SERVER_TIMESTAMP
+            })
+        batch.commit()
+
 def mark_attendance(db: firestore.Client, educator_id: str, date_str: str, present_students: List[str]):
     # ... (code is correct)
     pass
 
-def load_chat_history(db: firestore.Client, username: str):
-    """
-    Loads chat history for a given user from Firestore.
-    """
-    doc_ref = db.collection("chat_histories").document(username)
-    doc = doc_ref.get()
-    return doc.to_dict().get("messages", []) if doc.exists else []
+# --- Chat Sessions ---
+# Each conversation is a `chat_sessions/{session_id}` document with an append-only `messages`
+# subcollection. Messages carry a `seq` number, which orders them and serves as the paging cursor.
+def create_chat_session(db: firestore.Client, owner_id: str) -> str:
+    _, session_ref = db.collection("chat_sessions").add({
+        "owner_id": owner_id,
+        "message_count": 0,
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    })
+    return session_ref.id
+
+def get_chat_session(db: firestore.Client, session_id: str) -> Optional[Dict]:
+    doc = db.collection("chat_sessions").document(session_id).get()
+    if doc.exists:
+        data = doc.to_dict()
+        data["id"] = doc.id
+        return data
+    return None
+
+def get_chat_sessions_for_user(db: firestore.Client, owner_id: str) -> List[Dict]:
+    """Returns the user's chat sessions, most recently active first."""
+    sessions = []
+    for doc in db.collection("chat_sessions").where("owner_id", "==", owner_id).stream():
+        data = doc.to_dict()
+        data["id"] = doc.id
+        sessions.append(data)
+    sessions.sort(key=lambda session: session.get("updated_at") or 0, reverse=True)
+    return sessions
+
+def append_chat_messages(db: firestore.Client, session_id: str, messages: List[Dict]):
+    """Appends messages to a session, numbering them after the existing ones. Earlier messages are never rewritten."""
+    session_ref = db.collection("chat_sessions").document(session_id)
+
+    @firestore.transactional
+    def append_in_transaction(transaction):
+        seq = session_ref.get(transaction=transaction).to_dict().get("message_count", 0)
+        for message in messages:
+            transaction.set(session_ref.collection("messages").document(), {
+                "seq": seq,
+                "role": message["role"],
+                "content": message["content"],
+                "created_at": firestore.SERVER_TIMESTAMP,
+            })
+            seq += 1
+        transaction.update(session_ref, {"message_count": seq, "updated_at": firestore.SERVER_TIMESTAMP})
+
+    append_in_transaction(db.transaction())
+
+def update_chat_summary(db: firestore.Client, session_id: str, summary: str, summarized_through_seq: int):
+    """Stores the rolling summary covering every message up to and including `summarized_through_seq`."""
+    db.collection("chat_sessions").document(session_id).update({
+        "summary": summary,
+        "summarized_through_seq": summarized_through_seq,
+    })
 
-def save_chat_history(db: firestore.Client, username: str, messages: list):
+def get_chat_messages(db: firestore.Client, session_id: str, limit: int, before_seq: Optional[int] = None) -> List[Dict]:
     """
-    Saves chat history for a given user to Firestore.
+    Returns up to `limit` messages of a session in chronological order: the latest ones, or
+    those just before `before_seq` when paging back through older history.
     """
-    doc_ref = db.collection("chat_histories").document(username)
-    doc_ref.set({"messages": messages})
+    query = db.collection("chat_sessions").document(session_id).collection("messages")
+    if before_seq is not None:
+        query = query.where("seq", "<", before_seq)
+    query = query.order_by("seq", direction=firestore.Query.DESCENDING).limit(limit)
+    messages = [
+        {"seq": doc.get("seq"), "role": doc.get("role"), "content": doc.get("content")}
+        for doc in query.stream()
+    ]
+    messages.reverse()
+    return messages
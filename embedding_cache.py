@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# --- Configuration ---
+# The store is pruned to about this many megabytes of vectors, and vectors older than this many days are dropped.
+# At 768 float32 dimensions, 512 MB holds roughly 170,000 vectors.
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", 512))
+EMBEDDING_CACHE_MAX_AGE_DAYS = float(os.getenv("EMBEDDING_CACHE_MAX_AGE_DAYS", 30))
+# Pruning runs after every this many writes rather than on each one.
+PRUNE_EVERY_WRITES = 100
+
+
+class EmbeddingStore:
+    """
+    A persistent, content-addressed store of embedding vectors backed by SQLite.
+
+    Vectors are keyed by (model, sha256 of the text). The database runs in WAL mode, so
+    every backend process on the host can read and write the same file concurrently.
+    It is bounded by the bytes of vectors stored and by age; the oldest vectors are pruned first.
+    """
+
+    def __init__(self, path: str, max_bytes: int = int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024),
+                 max_age_s: float = EMBEDDING_CACHE_MAX_AGE_DAYS * 86400):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+            "created_at REAL NOT NULL DEFAULT 0, PRIMARY KEY (model, text_hash))"
+        )
+        # Files created before pruning existed lack the column; their rows count as oldest.
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")]
+        if "created_at" not in columns:
+            self._conn.execute("ALTER TABLE embeddings ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get_many(self, model: str, text_hashes: List[str]) -> Dict[str, List[float]]:
+        """Returns the cached vectors for the given hashes; missing hashes are left out."""
+        found = {}
+        with self._lock:
+            # Stay well under SQLite's limit on bound parameters per statement.
+            for i in range(0, len(text_hashes), 500):
+                chunk = text_hashes[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *chunk],
+                ).fetchall()
+                for text_hash, vector in rows:
+                    found[text_hash] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, vectors: Dict[str, List[float]]):
+        """Stores vectors keyed by text hash."""
+        now = time.time()
+        rows = [(model, text_hash, np.asarray(vector, dtype=np.float32).tobytes(), now) for text_hash, vector in vectors.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, created_at) VALUES (?, ?, ?, ?)", rows
+            )
+            self._conn.commit()
+            self._writes += 1
+            if self._writes % PRUNE_EVERY_WRITES == 0:
+                self._prune(now)
+
+    def _prune(self, now: float):
+        # Must be called with self._lock held.
+        self._conn.execute("DELETE FROM embeddings WHERE created_at < ?", (now - self.max_age_s,))
+        count, total_bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        if total_bytes > self.max_bytes:
+            # Vectors of one model all have the same size, so the excess converts to a row count.
+            excess_rows = count - int(self.max_bytes / (total_bytes / count))
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY created_at LIMIT ?)",
+                (excess_rows,),
+            )
+        self._conn.commit()
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings client so only texts that have never been embedded with this model reach the API.
+    Document and query vectors are cached separately, since some models embed them differently.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, store: EmbeddingStore):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str], progress=None) -> List[List[float]]:
+        """`progress(done, total)` is forwarded to the underlying client, counting cached texts as done."""
+        cached, missing = self._lookup(f"{self.model_name}:document", texts)
+        if missing:
+            kwargs = {}
+            if progress:
+                already_done = len(cached)
+                kwargs["progress"] = lambda done, total: progress(already_done + done, already_done + total)
+            vectors = self.underlying.embed_documents(list(missing.values()), **kwargs)
+            self._store(f"{self.model_name}:document", cached, missing, vectors)
+        elif progress:
+            progress(len(cached), len(cached))
+        return [cached[hash_text(text)] for text in texts]
+
+    # The async methods run SQLite work in the default executor: a write lock held by another
+    # process can block for up to the connection timeout and must not stall the event loop.
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        loop = asyncio.get_running_loop()
+        cached, missing = await loop.run_in_executor(None, self._lookup, f"{self.model_name}:document", texts)
+        if missing:
+            vectors = await self.underlying.aembed_documents(list(missing.values()))
+            await loop.run_in_executor(None, self._store, f"{self.model_name}:document", cached, missing, vectors)
+        return [cached[hash_text(text)] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        cached, missing = self._lookup(f"{self.model_name}:query", [text])
+        if missing:
+            self._store(f"{self.model_name}:query", cached, missing, [self.underlying.embed_query(text)])
+        return cached[hash_text(text)]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        cached, missing = await loop.run_in_executor(None, self._lookup, f"{self.model_name}:query", [text])
+        if missing:
+            vector = await self.underlying.aembed_query(text)
+            await loop.run_in_executor(None, self._store, f"{self.model_name}:query", cached, missing, [vector])
+        return cached[hash_text(text)]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def _lookup(self, namespace: str, texts: List[str]):
+        # Returns ({hash: vector} already cached, {hash: text} still to embed), deduplicating repeated texts.
+        unique = {hash_text(text): text for text in texts}
+        cached = self.store.get_many(namespace, list(unique))
+        missing = {text_hash: text for text_hash, text in unique.items() if text_hash not in cached}
+        self.hits += len(unique) - len(missing)
+        self.misses += len(missing)
+        return cached, missing
+
+    def _store(self, namespace: str, cached: dict, missing: dict, vectors: List[List[float]]):
+        new_vectors = dict(zip(missing.keys(), vectors))
+        self.store.put_many(namespace, new_vectors)
+        cached.update(new_vectors)
@@ -0,0 +1,71 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+from google.cloud import storage
+
+# --- Configuration ---
+# Number of blobs moved in parallel, and the matching HTTP connection pool size.
+TRANSFER_WORKERS = int(os.getenv("GCS_TRANSFER_WORKERS", 8))
+HTTP_POOL_SIZE = int(os.getenv("GCS_HTTP_POOL_SIZE", 32))
+
+_client = None
+_client_lock = threading.Lock()
+
+# --- Pooled Client ---
+def get_storage_client():
+    """Returns the process-wide GCS client, creating it with a pooled HTTP session on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                client = storage.Client()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+                )
+                client._http.mount("https://", adapter)
+                _client = client
+    return _client
+
+def set_storage_client(client):
+    """Replaces the process-wide client, e.g. with a local fake for benchmarks."""
+    global _client
+    with _client_lock:
+        _client = client
+
+# --- Transfers ---
+def list_blobs(bucket_name: str, prefix: str) -> List:
+    """Lists the blobs under a prefix using the pooled client."""
+    return list(get_storage_client().list_blobs(bucket_name, prefix=prefix))
+
+def upload_bytes(bucket_name: str, prefix: str, files: Dict[str, bytes], max_workers: int = TRANSFER_WORKERS):
+    """Uploads in-memory files to `{prefix}/{name}` concurrently."""
+    bucket = get_storage_client().bucket(bucket_name)
+
+    def upload(item):
+        name, data = item
+        bucket.blob(f"{prefix}/{name}").upload_from_string(data)
+
+    _run_concurrently(upload, list(files.items()), max_workers)
+
+def download_bytes(blobs: List, max_workers: int = TRANSFER_WORKERS) -> Dict[str, bytes]:
+    """Downloads blobs concurrently and returns their contents keyed by base name."""
+    def download(blob):
+        return os.path.basename(blob.name), blob.download_as_bytes()
+
+    return dict(_run_concurrently(download, blobs, max_workers))
+
+def download_to_dir(blobs: List, target_dir: str, max_workers: int = TRANSFER_WORKERS):
+    """Downloads blobs concurrently into target_dir under their base names."""
+    def download(blob):
+        blob.download_to_filename(os.path.join(target_dir, os.path.basename(blob.name)))
+
+    _run_concurrently(download, blobs, max_workers)
+
+def _run_concurrently(func, items: List, max_workers: int) -> List:
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+import ai
+
+# --- Configuration ---
+GRADING_PROVIDER = os.getenv("GRADING_LLM_PROVIDER", "TogetherAI")
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", 16))
+
+GRADING_SYSTEM_PROMPT = "You are a fair and helpful grading assistant who provides clear, actionable feedback. You always respond in JSON format."
+
+
+def build_grading_prompt(assignment_description: str, content: str) -> str:
+    """
+    Builds the grading prompt. Everything before the submission depends only on the assignment,
+    so every submission to the same assignment shares one prompt prefix that providers can cache.
+    """
+    return f"""
+    You are an expert teaching assistant. Your task is to grade a student's submission.
+    Provide a numerical score out of 100 and constructive feedback.
+    Return your response as a JSON object with two keys: "grade" (an integer) and "feedback" (a string).
+
+    Original Assignment Description:
+    ---
+    {assignment_description}
+    ---
+
+    Student's Submission:
+    ---
+    {content}
+    ---
+    """
+
+
+def parse_grade(ai_response_str: str) -> Tuple[int, str]:
+    """Parses the model's JSON reply into (grade, feedback). Raises ValueError if it is malformed."""
+    try:
+        grade_data = json.loads(ai_response_str)
+        grade = int(grade_data.get("grade", 0))
+        feedback = grade_data.get("feedback", "No feedback provided.")
+    except (json.JSONDecodeError, TypeError, ValueError, AttributeError):
+        raise ValueError("AI returned an invalid format for the grade.")
+    return grade, feedback
+
+
+async def grade_submission(assignment_description: str, content: str, clients: dict = None) -> Tuple[int, str]:
+    """Grades one submission. Raises ValueError if the provider fails or replies in the wrong format."""
+    ai_response_str = await ai.get_ai_response(
+        provider=GRADING_PROVIDER,
+        system_prompt=GRADING_SYSTEM_PROMPT,
+        messages=[{"role": "user", "content": build_grading_prompt(assignment_description, content)}],
+        use_rag=False,
+        clients=clients
+    )
+    if "An error occurred" in ai_response_str:
+        raise ValueError(ai_response_str)
+    return parse_grade(ai_response_str)
+
+
+async def grade_submissions(submissions: List[Dict], assignments: Dict[str, Dict], clients: dict = None,
+                            max_concurrency: int = GRADING_CONCURRENCY) -> List[Dict]:
+    """
+    Grades many submissions concurrently, at most `max_concurrency` at a time.
+
+    `submissions` are dicts with assignment_id, student_id and content; `assignments` maps ids to
+    assignment documents. Submissions with the same assignment and content (ignoring surrounding
+    whitespace) are graded once and share the result. Returns one result per submission, in order,
+    with either grade and feedback or an error.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    unique = {}  # dedup key -> task
+
+    async def grade_once(assignment_id: str, content: str) -> Tuple[int, str]:
+        async with semaphore:
+            return await grade_submission(assignments[assignment_id]["description"], content, clients)
+
+    tasks = []
+    for submission in submissions:
+        if submission["assignment_id"] not in assignments:
+            tasks.append(None)
+            continue
+        key = _dedup_key(submission["assignment_id"], submission["content"])
+        if key not in unique:
+            unique[key] = asyncio.ensure_future(grade_once(submission["assignment_id"], submission["content"]))
+        tasks.append(unique[key])
+    await asyncio.gather(*unique.values(), return_exceptions=True)
+
+    results = []
+    for submission, task in zip(submissions, tasks):
+        result = {"assignment_id": submission["assignment_id"], "student_id": submission["student_id"],
+                  "grade": None, "feedback": None, "error": None}
+        if task is None:
+            result["error"] = "Assignment not found."
+        elif task.exception() is not None:
+            result["error"] = str(task.exception())
+        else:
+            result["grade"], result["feedback"] = task.result()
+        results.append(result)
+    return results
+
+
+def _dedup_key(assignment_id: str, content: str) -> str:
+    return hashlib.sha256(f"{assignment_id}\n{content.strip()}".encode("utf-8")).hexdigest()
@@ -0,0 +1,306 @@
+import itertools
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import database
+import gcs_transfer
+import pdf_parsing
+import rag
+
+# --- Configuration ---
+# Batches are capped both by number of texts and by an estimate of their total tokens.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", 32768))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 8))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 6))
+
+# progress(done, total) is called as chunks finish embedding.
+ProgressCallback = Callable[[int, int], None]
+
+
+def estimate_tokens(text: str) -> int:
+    """A cheap token estimate (about four characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+def pack_batches(texts: List[str], max_texts: int, max_tokens: int) -> List[range]:
+    """Splits texts into consecutive index ranges that respect both batch limits."""
+    batches, start, tokens = [], 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = estimate_tokens(text)
+        if i > start and (i - start >= max_texts or tokens + text_tokens > max_tokens):
+            batches.append(range(start, i))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append(range(start, len(texts)))
+    return batches
+
+
+def is_retryable(error: Exception) -> bool:
+    """True for rate limits, server errors and timeouts."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return "rate limit" in str(error).lower() or "timeout" in type(error).__name__.lower()
+
+
+def _retry_after_s(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TogetherBatchEmbeddings(Embeddings):
+    """
+    Embeddings client for ingestion that sends many chunks per request.
+
+    embed_documents packs chunks into batches sized for the model's limits and embeds
+    several batches concurrently. Rate-limited or failed batches are retried with
+    exponential backoff and jitter, honouring Retry-After when the API sends it.
+    """
+
+    def __init__(self, model: str, api_key: str, batch_size: int = EMBEDDING_BATCH_SIZE,
+                 max_batch_tokens: int = EMBEDDING_BATCH_MAX_TOKENS, max_concurrency: int = EMBEDDING_CONCURRENCY,
+                 max_retries: int = EMBEDDING_MAX_RETRIES):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._api_key = api_key
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Created on first use, so importing the Together SDK does not slow down startup.
+        with self._client_lock:
+            if self._client is None:
+                from together import Together
+                # Retries are handled here, so the SDK should fail fast and let the backoff loop decide.
+                self._client = Together(api_key=self._api_key, max_retries=0)
+            return self._client
+
+    def embed_documents(self, texts: List[str], progress: Optional[ProgressCallback] = None) -> List[List[float]]:
+        vectors = [None] * len(texts)
+        batches = pack_batches(texts, self.batch_size, self.max_batch_tokens)
+        done = 0
+        done_lock = threading.Lock()
+
+        def embed(batch: range):
+            nonlocal done
+            batch_vectors = self._embed_with_backoff([texts[i] for i in batch])
+            vectors[batch.start:batch.stop] = batch_vectors
+            with done_lock:
+                done += len(batch)
+                if progress:
+                    progress(done, len(texts))
+
+        if len(batches) <= 1:
+            for batch in batches:
+                embed(batch)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                list(executor.map(embed, batches))
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_with_backoff([text])[0]
+
+    def _embed_with_backoff(self, batch: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.client.embeddings.create(model=self.model, input=batch)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable(e):
+                    raise
+                delay = _retry_after_s(e) or min(30.0, 0.5 * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.8, 1.2))
+
+
+# --- Document Parsing ---
+PDF_PAGES_PER_WINDOW = int(os.getenv("INGESTION_PDF_PAGES_PER_WINDOW", 25))
+TEXT_CHARS_PER_WINDOW = int(os.getenv("INGESTION_TEXT_CHARS_PER_WINDOW", 200_000))
+
+
+def iter_document_windows(path: str, filename: str, parse_pool=None, windows_ahead: int = 1):
+    """
+    Reads an uploaded file lazily as (documents, done, total) windows of bounded size.
+    PDF page ranges are parsed in `parse_pool` (a process pool) when given, at most `windows_ahead`
+    windows ahead of the consumer; `done`/`total` count pages for PDFs and bytes for text files.
+    """
+    if filename.lower().endswith(".pdf"):
+        return _iter_pdf_windows(path, filename, parse_pool, windows_ahead)
+    return _iter_text_windows(path, filename)
+
+
+def _iter_pdf_windows(path: str, filename: str, parse_pool, windows_ahead: int):
+    total_pages = pdf_parsing.count_pdf_pages(path)
+    page_ranges = [(start, min(start + PDF_PAGES_PER_WINDOW, total_pages)) for start in range(0, total_pages, PDF_PAGES_PER_WINDOW)]
+    if parse_pool is None:
+        for start, stop in page_ranges:
+            yield pdf_parsing.parse_pdf_pages(path, filename, start, stop), stop, total_pages
+        return
+
+    # Keep only a bounded number of parsed windows waiting, so memory stays flat for any page count.
+    in_flight = deque()
+    pending = iter(page_ranges)
+    for start, stop in itertools.islice(pending, max(1, windows_ahead)):
+        in_flight.append((stop, parse_pool.submit(pdf_parsing.parse_pdf_pages, path, filename, start, stop)))
+    while in_flight:
+        stop, future = in_flight.popleft()
+        docs = future.result()
+        for next_start, next_stop in itertools.islice(pending, 1):
+            in_flight.append((next_stop, parse_pool.submit(pdf_parsing.parse_pdf_pages, path, filename, next_start, next_stop)))
+        yield docs, stop, total_pages
+
+
+def _iter_text_windows(path: str, filename: str):
+    total_bytes = os.path.getsize(path)
+    done = 0
+    carry = ""
+    with open(path, encoding="utf-8") as f:
+        while True:
+            block = f.read(TEXT_CHARS_PER_WINDOW)
+            text = carry + block
+            if not block:
+                if text:
+                    yield [Document(page_content=text, metadata={"source": filename})], total_bytes, total_bytes
+                return
+            # Cut after the last paragraph break, or the last line break if the window has none,
+            # so windows do not split sentences.
+            cut = text.rfind("\n\n")
+            if cut > 0:
+                cut += 2
+            else:
+                cut = text.rfind("\n")
+                cut = cut + 1 if cut > 0 else len(text)
+            window, carry = text[:cut], text[cut:]
+            done += len(window.encode("utf-8"))
+            yield [Document(page_content=window, metadata={"source": filename})], min(done, total_bytes), total_bytes
+
+
+# --- Background Ingestion Jobs ---
+class IngestionQueue:
+    """
+    Runs document ingestion jobs (parse, split, embed, save) in a bounded worker pool.
+
+    Job state lives in Firestore and the raw upload in GCS, so nothing is lost if this process
+    dies: a worker holds a job only while its lease is renewed, and `recover` picks up any
+    job whose lease has expired, on this host or another.
+    """
+
+    def __init__(self, db, bucket_name: str, embeddings, max_concurrency: int, lease_s: float, parse_processes: int = 0,
+                 max_attempts: int = 3):
+        self.db = db
+        self.bucket_name = bucket_name
+        self.embeddings = embeddings
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="ingestion")
+        # PDF text extraction is CPU-bound, so it runs in separate processes. "spawn" avoids forking a threaded server.
+        self._parse_pool = None
+        self._parse_processes = parse_processes
+        if parse_processes > 0:
+            self._parse_pool = ProcessPoolExecutor(max_workers=parse_processes, mp_context=multiprocessing.get_context("spawn"))
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def submit(self, job_id: str):
+        """Queues a job for this process, unless it is already queued here."""
+        with self._pending_lock:
+            if job_id in self._pending:
+                return
+            self._pending.add(job_id)
+        self._executor.submit(self._run, job_id)
+
+    def recover(self) -> int:
+        """Queues every unfinished job without a live owner. Returns how many were queued."""
+        job_ids = database.get_unfinished_ingestion_job_ids(self.db, time.time())
+        for job_id in job_ids:
+            self.submit(job_id)
+        return len(job_ids)
+
+    def shutdown(self):
+        # Running jobs are abandoned; their leases expire and another worker resumes them.
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self._parse_pool:
+            self._parse_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job_id: str):
+        job = None
+        try:
+            job = database.claim_ingestion_job(self.db, job_id, self.worker_id, time.time(), self.lease_s)
+            if job and job["attempts"] > self.max_attempts:
+                # Earlier attempts died without failing the job (e.g. the worker ran out of memory); stop retrying it.
+                raise RuntimeError(f"Gave up after {self.max_attempts} attempts.")
+            if job:
+                self._process(job_id, job)
+        except Exception as e:
+            print(f"Ingestion job {job_id} failed: {e}")
+            try:
+                reserved_bytes = job["reserved_bytes"] if job else 0
+                if database.fail_ingestion_job(self.db, job_id, self.worker_id, reserved_bytes, str(e)) and job:
+                    self._delete_staged_upload(job)
+            except Exception as fail_error:
+                print(f"Could not mark ingestion job {job_id} as failed: {fail_error}")
+        finally:
+            with self._pending_lock:
+                self._pending.discard(job_id)
+
+    def _process(self, job_id: str, job: dict):
+        last_update = 0.0
+
+        def report(stage: str, progress: float, force: bool = False):
+            # Progress writes double as lease renewals; throttle them to about one per second.
+            nonlocal last_update
+            now = time.time()
+            if force or now - last_update >= 1.0:
+                database.update_ingestion_job(self.db, job_id, {
+                    "stage": stage, "progress": progress, "lease_expires_at": now + self.lease_s,
+                })
+                last_update = now
+
+        report("parsing", 0.0, force=True)
+        upload_blobs = gcs_transfer.list_blobs(self.bucket_name, job["upload_prefix"])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # Stream the upload to disk rather than into memory; pages are then read lazily from the file.
+            gcs_transfer.download_to_dir(upload_blobs, temp_dir)
+            windows = iter_document_windows(os.path.join(temp_dir, job["filename"]), job["filename"], self._parse_pool, self._parse_processes)
+            # Parsing and embedding are interleaved window by window and together span most of the progress.
+            vector_store = rag.create_vector_store_incrementally(
+                windows, self.embeddings, progress=lambda done, total: report("embedding", 0.9 * done / max(total, 1))
+            )
+
+        report("saving", 0.9, force=True)
+        stored_bytes = rag.save_vector_store_to_gcs(vector_store, self.bucket_name, job["gcs_path"])
+        if not stored_bytes:
+            raise RuntimeError("Failed to save the processed document.")
+        database.add_document_metadata(
+            self.db, job["owner_id"], job["gcs_path"], job["category"], job["filename"], job["doc_id"],
+            index_stats=getattr(vector_store, "index_stats", None),
+        )
+        if database.complete_ingestion_job(self.db, job_id, self.worker_id, job["reserved_bytes"], stored_bytes):
+            for blob in upload_blobs:
+                blob.delete()
+
+    def _delete_staged_upload(self, job: dict):
+        """Deletes the raw upload of a failed job, which no quota counts and nothing will read again."""
+        for blob in gcs_transfer.list_blobs(self.bucket_name, job["upload_prefix"]):
+            blob.delete()
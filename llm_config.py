@@ -1,18 +1,34 @@
 # This file will contain the configuration for various LLM providers.
 # In a real-world scenario, this might be more complex, loading from YAML or another config format.
+import os
 
+# `max_concurrency` caps in-flight requests to a provider per backend worker.
+# `max_connections` sizes the HTTP connection pool of the Together and OpenAI clients (Gemini multiplexes
+# its calls over one gRPC channel), and `timeout_s` bounds each request.
+# `context_budget_tokens` caps the prompt (system prompt, summary, history, retrieved chunks) sent per call.
 LLM_PROVIDERS = {
     "TogetherAI": {
         "model": "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free",
         "api_key_env": "TOGETHER_API_KEY",
+        "max_concurrency": int(os.getenv("TOGETHER_MAX_CONCURRENCY", 100)),
+        "max_connections": int(os.getenv("TOGETHER_MAX_CONNECTIONS", 100)),
+        "timeout_s": float(os.getenv("TOGETHER_TIMEOUT_S", 60)),
+        "context_budget_tokens": int(os.getenv("TOGETHER_CONTEXT_BUDGET_TOKENS", 8000)),
     },
     "OpenAI": {
         "model": "gpt-4-turbo",
         "api_key_env": "OPENAI_API_KEY",
+        "max_concurrency": int(os.getenv("OPENAI_MAX_CONCURRENCY", 100)),
+        "max_connections": int(os.getenv("OPENAI_MAX_CONNECTIONS", 100)),
+        "timeout_s": float(os.getenv("OPENAI_TIMEOUT_S", 60)),
+        "context_budget_tokens": int(os.getenv("OPENAI_CONTEXT_BUDGET_TOKENS", 16000)),
     },
     "Google": {
         "model": "gemini-1.5-pro-latest",
         "api_key_env": "GOOGLE_API_KEY",
+        "max_concurrency": int(os.getenv("GOOGLE_MAX_CONCURRENCY", 100)),
+        "timeout_s": float(os.getenv("GOOGLE_TIMEOUT_S", 60)),
+        "context_budget_tokens": int(os.getenv("GOOGLE_CONTEXT_BUDGET_TOKENS", 32000)),
     }
     # Anthropic, Hugging Face, etc., could be added here following the same pattern.
 }
@@ -1,25 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Header
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Header, Query, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
+import asyncio
+import functools
 import os
 import tempfile
+import time
 import uuid
 import json
 from dotenv import load_dotenv
 
-# Langchain Imports
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain_together import TogetherEmbeddings
-from together import Together
-
 # Local Imports
 import database
 import ai
 import rag
 import auth
-from models import User, UserCreate, Token, RAGScope, ChatRequest, ChatResponse, UploadResponse, AssignmentRequest, AssignmentResponse, DocumentResponse, AttendanceRequest, SubmissionRequest, GradeResponse 
+import chat_context
+from llm_config import LLM_PROVIDERS
+import gcs_transfer
+import grading
+import metrics
+from ingestion import IngestionQueue
+from vector_cache import VectorStoreCache, VectorStoreDiskCache
+from response_cache import ResponseCache
+from models import User, UserCreate, Token, RAGScope, ChatRequest, ChatResponse, ChatSessionResponse, ChatHistoryMessage, ChatMessagesPage, UploadResponse, AssignmentRequest, AssignmentResponse, DocumentResponse, AttendanceRequest, SubmissionRequest, GradeResponse, BatchSubmissionRequest, ClassGradingRequest, BatchGradeResult, GRADING_MAX_SUBMISSIONS
 
 
 # Load environment variables
@@ -35,20 +43,130 @@ async def lifespan(app: FastAPI):
     print("Application starting up...")
     
     # This block runs on startup
+    # Firestore and GCS calls have no async path here, so they run in a bounded pool off the event loop.
+    app.state.io_executor = ThreadPoolExecutor(
+        max_workers=int(os.getenv("BLOCKING_IO_WORKERS", 64)), thread_name_prefix="blocking-io"
+    )
     app.state.db = database.init_firestore()
-    app.state.embeddings = ai.get_embedding_client()
+    app.state.embeddings = ai.get_embedding_client(
+        cache_path=os.getenv("EMBEDDING_CACHE_PATH", os.path.join(tempfile.gettempdir(), "embedding_cache.sqlite3"))
+    )
+    app.state.llm_clients = ai.create_provider_clients()
+    app.state.storage_client = gcs_transfer.get_storage_client()
     app.state.gcs_bucket_name = os.getenv("GCS_BUCKET_NAME")
     app.state.storage_limit_mb = float(os.getenv("USER_STORAGE_LIMIT_MB", 100.0))
+    app.state.password_hasher = auth.PasswordHasher(
+        max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)),
+        max_queue=int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 64)),
+    )
+    app.state.user_cache = auth.UserCache(
+        max_entries=int(os.getenv("AUTH_USER_CACHE_MAX_ENTRIES", 10000)),
+        ttl_s=float(os.getenv("AUTH_USER_CACHE_TTL_S", 30)),
+    )
+    app.state.chat_context_messages = int(os.getenv("CHAT_CONTEXT_MESSAGES", 40))
+    app.state.summarizing_sessions = set()
+    app.state.assignment_inline_fanout_max = int(os.getenv("ASSIGNMENT_INLINE_FANOUT_MAX", 500))
+    app.state.background_tasks = set()
+    app.state.vector_store_cache = VectorStoreCache(
+        max_bytes=int(float(os.getenv("VECTOR_STORE_CACHE_MB", 512.0)) * 1024 * 1024),
+        fresh_s=float(os.getenv("VECTOR_STORE_FRESH_S", 30)),
+    )
+    app.state.response_cache = None
+    if os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true":
+        similarity_threshold = os.getenv("RESPONSE_CACHE_SIMILARITY_THRESHOLD")
+        app.state.response_cache = ResponseCache(
+            max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 10000)),
+            ttl_s=float(os.getenv("RESPONSE_CACHE_TTL_S", 3600)),
+            tail_turns=int(os.getenv("RESPONSE_CACHE_TAIL_TURNS", 3)),
+            similarity_threshold=float(similarity_threshold) if similarity_threshold else None,
+        )
+    app.state.vector_store_disk_cache = VectorStoreDiskCache(
+        os.getenv("VECTOR_STORE_DISK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "vector_store_cache")),
+        max_bytes=int(float(os.getenv("VECTOR_STORE_DISK_CACHE_MB", 10240)) * 1024 * 1024),
+    )
     if not app.state.gcs_bucket_name:
         raise RuntimeError("GCS_BUCKET_NAME not found in environment variables.")
+    app.state.ingestion_queue = IngestionQueue(
+        app.state.db,
+        app.state.gcs_bucket_name,
+        app.state.embeddings,
+        max_concurrency=int(os.getenv("INGESTION_CONCURRENCY", 2)),
+        lease_s=float(os.getenv("INGESTION_LEASE_S", 600)),
+        parse_processes=int(os.getenv("INGESTION_PARSE_PROCESSES", 2)),
+        max_attempts=int(os.getenv("INGESTION_MAX_ATTEMPTS", 3)),
+    )
+    recover_task = asyncio.create_task(
+        recover_ingestion_jobs_periodically(float(os.getenv("INGESTION_RECOVERY_INTERVAL_S", 60)))
+    )
+
+    reconcile_interval_s = float(os.getenv("STORAGE_RECONCILE_INTERVAL_S", 3600))
+    reconcile_task = None
+    if reconcile_interval_s > 0:
+        reconcile_task = asyncio.create_task(reconcile_storage_usage_periodically(reconcile_interval_s))
+    if os.getenv("PRELOAD_IMPORTS", "true").lower() == "true":
+        # Provider SDKs, FAISS and tokenizers load on first use; warm them up off the startup path instead.
+        app.state.io_executor.submit(preload_imports)
     print("FastAPI server started successfully.")
 
     yield # This is where the application starts serving requests.
 
     # This block runs on shutdown
     print("Application shutting down...")
+    if reconcile_task:
+        reconcile_task.cancel()
+    recover_task.cancel()
+    app.state.ingestion_queue.shutdown()
+    app.state.password_hasher.shutdown()
+    await ai.close_provider_clients(app.state.llm_clients)
+    app.state.io_executor.shutdown(wait=False)
     # Add any cleanup code here if necessary, e.g., closing database connections.
 
+def preload_imports():
+    start = time.perf_counter()
+    try:
+        ai.preload_provider_sdks()
+        rag.preload()
+        chat_context.preload_encodings({config["model"] for config in LLM_PROVIDERS.values()})
+    except Exception as e:
+        print(f"Preloading imports failed: {e}")
+        return
+    print(f"Preloaded provider SDKs, FAISS and tokenizers in {time.perf_counter() - start:.1f} s")
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking Firestore/GCS/FAISS call in the bounded I/O executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.io_executor, functools.partial(func, *args, **kwargs))
+
+async def reconcile_storage_usage_periodically(interval_s: float):
+    """
+    Repairs drift between the Firestore usage counters and the bucket contents.
+    Every worker runs this loop, but only the one holding the reconcile lease does the work each round.
+    """
+    holder = app.state.ingestion_queue.worker_id
+    while True:
+        await asyncio.sleep(interval_s)
+        try:
+            if not await run_blocking(database.try_acquire_lease, app.state.db, "storage_reconcile", holder, time.time(), interval_s):
+                continue
+            # Counters are read before the listing, so users whose counters move meanwhile are skipped.
+            snapshot = await run_blocking(database.get_storage_usage_snapshot, app.state.db)
+            actual_usage = await run_blocking(rag.get_storage_usage_by_user, app.state.gcs_bucket_name)
+            reconciled, skipped = await run_blocking(database.reconcile_storage_usage, app.state.db, snapshot, actual_usage)
+            print(f"Reconciled storage usage for {reconciled} users, skipped {skipped} with changes in flight.")
+        except Exception as e:
+            print(f"Storage usage reconciliation failed: {e}")
+
+async def recover_ingestion_jobs_periodically(interval_s: float):
+    """Resumes ingestion jobs left unfinished by a stopped worker, at startup and then periodically."""
+    while True:
+        try:
+            recovered = await run_blocking(app.state.ingestion_queue.recover)
+            if recovered:
+                print(f"Queued {recovered} unfinished ingestion jobs.")
+        except Exception as e:
+            print(f"Ingestion job recovery failed: {e}")
+        await asyncio.sleep(interval_s)
+
 # --- FastAPI App Initialization ---
 app = FastAPI(
     title="Educational AI Platform API",
@@ -57,16 +175,43 @@ app = FastAPI(
     lifespan=lifespan # Pass the lifespan context manager here
 )
 
+# --- Request Timing ---
+if metrics.ENABLED:
+    @app.middleware("http")
+    async def time_request(request: Request, call_next):
+        """
+        Records each request's duration per route, and reports the stages timed so far in a Server-Timing header.
+        The duration runs until the last byte of the body is sent, so streamed replies are timed in full; stages
+        that finish after the headers are sent, such as the provider call of a streamed reply, only reach /metrics.
+        """
+        timing = metrics.start_request(request.scope)
+        start = time.perf_counter()
+        response = await call_next(request)
+        response.headers["Server-Timing"] = timing.server_timing(time.perf_counter() - start)
+        body_iterator = response.body_iterator
+
+        async def observe_when_sent():
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                total_s = time.perf_counter() - start
+                metrics.REQUEST_SECONDS.observe((timing.endpoint, request.method, str(response.status_code)), total_s)
+
+        response.body_iterator = observe_when_sent()
+        return response
+
 # --- App State & Dependencies ---
 def get_db():
     return app.state.db
 
 def get_current_user(token: str = Depends(auth.oauth2_scheme), db: ... = Depends(get_db)):
-    return auth.get_current_active_user(db, token)
+    with metrics.stage("auth"):
+        return auth.get_current_active_user(db, token, cache=app.state.user_cache)
 
-def get_current_educator(current_user: User = Depends(get_current_user), db: ... = Depends(get_db)):
-    # Assuming `auth.is_educator` is a function that checks the user's role.
-    if not auth.is_educator(db, current_user.username):
+def get_current_educator(current_user: User = Depends(get_current_user)):
+    # The role comes with the resolved user, so this needs no second lookup.
+    if not auth.is_educator(current_user):
         raise HTTPException(status_code=403, detail="Not an educator.")
     return current_user.username
 
@@ -76,6 +221,7 @@ class UserCreate(BaseModel):
     password: str
     email: Optional[str] = None
     full_name: Optional[str] = None
+    role: str = "student"
 
 class Token(BaseModel):
     access_token: str
@@ -86,19 +232,45 @@ class RAGScope(BaseModel):
     scope_id: str
 
 class ChatRequest(BaseModel):
-    messages: List[Dict]
+    message: str  # The new user turn; earlier turns are loaded from the session
+    session_id: Optional[str] = None  # Omit to start a new session
     persona: str
     educational_level: str
     llm_provider: str
     rag_scope: Optional[RAGScope] = None
+    bypass_cache: bool = False
 
 class ChatResponse(BaseModel):
     role: str
     content: str
+    session_id: str
+
+class ChatSessionResponse(BaseModel):
+    id: str
+    message_count: int
+
+class ChatHistoryMessage(BaseModel):
+    seq: int
+    role: str
+    content: str
+
+class ChatMessagesPage(BaseModel):
+    messages: List[ChatHistoryMessage]
+    next_before: Optional[int] = None  # Pass as `before` to fetch the previous page; None when there is none
 
 class UploadResponse(BaseModel):
     message: str
     doc_id: str
+    job_id: str
+
+class IngestionJobResponse(BaseModel):
+    id: str
+    status: str
+    stage: str
+    progress: float
+    doc_id: str
+    filename: str
+    error: Optional[str] = None
 
 class AssignmentRequest(BaseModel):
     title: str
@@ -128,6 +300,23 @@ class GradeResponse(BaseModel):
     grade: int
     feedback: str
 
+class BatchSubmissionRequest(BaseModel):
+    submissions: List[SubmissionRequest] = Field(..., max_length=GRADING_MAX_SUBMISSIONS)
+
+class ClassSubmission(BaseModel):
+    student_id: str
+    content: str
+
+class ClassGradingRequest(BaseModel):
+    submissions: List[ClassSubmission] = Field(..., max_length=GRADING_MAX_SUBMISSIONS)
+
+class BatchGradeResult(BaseModel):
+    assignment_id: str
+    student_id: str
+    grade: Optional[int] = None
+    feedback: Optional[str] = None
+    error: Optional[str] = None
+
 
 
 @app.get("/")
@@ -138,18 +327,39 @@ async def read_root():
 # --- Auth Endpoints ---
 @app.post("/token", response_model=Token)
 async def login_for_access_token(db: ... = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
-    user = database.authenticate_user(db, form_data.username, form_data.password)
-    if not user:
+    user_data = await run_blocking(database.get_user, db, form_data.username)
+    verified, new_hash = await hash_password_or_503(
+        app.state.password_hasher.verify_and_update,
+        form_data.password, user_data["hashed_password"] if user_data else None
+    )
+    if not verified:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
-    access_token = auth.create_access_token(data={"sub": user.username})
+    if new_hash:
+        # The cost factor changed since this password was hashed; upgrade it now that we have the plain text.
+        await run_blocking(database.update_password_hash, db, form_data.username, new_hash)
+    access_token = auth.create_access_token(
+        data={"sub": form_data.username, "role": user_data.get("role"), "school_id": user_data.get("school_id")}
+    )
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.post("/register", response_model=User)
 async def register_user(user_in: UserCreate, db: ... = Depends(get_db)):
-    db_user = database.get_user(db, user_in.username)
+    db_user = await run_blocking(database.get_user, db, user_in.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return database.create_user(db=db, user=user_in)
+    hashed_password = await hash_password_or_503(app.state.password_hasher.hash, user_in.password)
+    user = await run_blocking(database.create_user, db, user_in.username, hashed_password, user_in.role)
+    if not user:
+        raise HTTPException(status_code=400, detail="Username already registered")
+    return user
+
+async def hash_password_or_503(func, *args):
+    """Runs a password hashing call, turning a saturated hashing pool into a fast 503."""
+    try:
+        return await func(*args)
+    except auth.PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins right now. Please try again shortly.",
+                            headers={"Retry-After": "1"})
 
 # --- User & Classroom Endpoints ---
 @app.get("/users/me", response_model=User)
@@ -160,100 +370,414 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
 # ...
 
 # --- Document Endpoints ---
-@app.post("/documents", response_model=UploadResponse)
+@app.post("/documents", response_model=UploadResponse, status_code=202)
 async def upload_document_endpoint(category: str = Form(...), file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
-    current_usage_mb = rag.get_user_storage_usage_mb(app.state.gcs_bucket_name, current_user.username)
-    file_size_mb = file.size / (1024 * 1024)
-
-    if current_usage_mb + file_size_mb > app.state.storage_limit_mb:
+    """
+    Accepts a document for ingestion and returns immediately with a job id.
+    Parsing, embedding and saving run in the background; poll GET /documents/jobs/{job_id} for progress.
+    """
+    # Reserve the upload size up front so concurrent uploads cannot both slip under the quota.
+    limit_bytes = int(app.state.storage_limit_mb * 1024 * 1024)
+    with metrics.stage("quota_reserve"):
+        reserved = await run_blocking(database.reserve_storage, app.state.db, current_user.username, file.size, limit_bytes)
+    if not reserved:
         raise HTTPException(
             status_code=413,
             detail=f"Upload would exceed your storage limit of {app.state.storage_limit_mb} MB."
         )
 
+    job_id = str(uuid.uuid4())
     doc_id = str(uuid.uuid4())
-    gcs_path = f"vector_stores/{current_user.username}/{doc_id}"
-    # ... (file processing and saving to GCS logic) ...
-    database.add_document_metadata(app.state.db, current_user.username, gcs_path, category, file.filename)
-    return {"message": "Document processed and saved.", "doc_id": doc_id}
+    filename = os.path.basename(file.filename)
+    upload_prefix = f"uploads/{current_user.username}/{job_id}"
+    try:
+        # The raw file is staged in GCS so the job can be resumed by any worker after a restart.
+        with metrics.stage("staging_upload"):
+            await run_blocking(gcs_transfer.upload_bytes, app.state.gcs_bucket_name, upload_prefix, {filename: await file.read()})
+        with metrics.stage("job_create"):
+            await run_blocking(database.create_ingestion_job, app.state.db, job_id, {
+                "owner_id": current_user.username,
+                "doc_id": doc_id,
+                "gcs_path": f"vector_stores/{current_user.username}/{doc_id}",
+                "upload_prefix": upload_prefix,
+                "filename": filename,
+                "category": category,
+                "reserved_bytes": file.size,
+                "status": "queued",
+                "stage": "queued",
+                "progress": 0.0,
+            })
+    except Exception:
+        await run_blocking(database.release_storage_reservation, app.state.db, current_user.username, file.size)
+        raise
+
+    app.state.ingestion_queue.submit(job_id)
+    return {"message": "Document accepted for processing.", "doc_id": doc_id, "job_id": job_id}
+
+@app.get("/documents/jobs/{job_id}", response_model=IngestionJobResponse)
+async def get_ingestion_job_endpoint(job_id: str, current_user: User = Depends(get_current_user)):
+    job = await run_blocking(database.get_ingestion_job, app.state.db, job_id)
+    if not job or job["owner_id"] != current_user.username:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@app.delete("/documents/{doc_id}")
+async def delete_document_endpoint(doc_id: str, current_user: User = Depends(get_current_user)):
+    document = await run_blocking(database.get_document, app.state.db, doc_id)
+    if not document or document["owner_id"] != current_user.username:
+        raise HTTPException(status_code=404, detail="Document not found.")
+
+    await run_blocking(database.begin_storage_release, app.state.db, current_user.username)
+    freed_bytes = 0
+    try:
+        freed_bytes = await run_blocking(rag.delete_vector_store_from_gcs, app.state.gcs_bucket_name, document["gcs_path"])
+        await run_blocking(database.delete_document_metadata, app.state.db, doc_id)
+    finally:
+        await run_blocking(database.release_storage, app.state.db, current_user.username, freed_bytes)
+    app.state.vector_store_cache.invalidate(document["gcs_path"])
+    await run_blocking(app.state.vector_store_disk_cache.invalidate, document["gcs_path"])
+    return {"message": "Document deleted."}
 
 @app.get("/documents", response_model=List[DocumentResponse])
 async def get_documents_endpoint(current_user: User = Depends(get_current_user)):
-    docs = database.get_documents_for_user(app.state.db, current_user.username)
+    docs = await run_blocking(database.get_documents_for_user, app.state.db, current_user.username)
     return docs
 
 # --- Chat Endpoint ---
+async def load_rag_vector_store(username: str, rag_scope: Optional[RAGScope]):
+    """
+    Loads the vector store selected by a chat request's RAG scope, if any.
+    A "document" scope loads one index; a "category" scope (scope_id is the category) or a
+    "library" scope searches all of the user's matching documents together. Each per-document
+    index comes from the vector store cache, so a warm scope costs no GCS downloads, and no GCS
+    requests at all while its generations were checked within VECTOR_STORE_FRESH_S.
+    """
+    if not rag_scope:
+        return None
+    if rag_scope.scope_type == "document":
+        return await load_document_vector_store(f"vector_stores/{username}/{rag_scope.scope_id}")
+    if rag_scope.scope_type not in ("category", "library"):
+        raise HTTPException(status_code=400, detail=f"Unsupported RAG scope type: {rag_scope.scope_type}")
+
+    category = rag_scope.scope_id if rag_scope.scope_type == "category" else None
+    documents = await run_blocking(database.get_documents_for_user, app.state.db, username, category)
+    vector_stores = await asyncio.gather(*(load_document_vector_store(doc["gcs_path"]) for doc in documents))
+    vector_stores = [store for store in vector_stores if store is not None]
+    if not vector_stores:
+        return None
+    return rag.MultiVectorStore(vector_stores, app.state.embeddings)
+
+async def load_document_vector_store(gcs_path_prefix: str):
+    return await run_blocking(
+        rag.load_vector_store_from_gcs,
+        app.state.gcs_bucket_name, gcs_path_prefix, app.state.embeddings,
+        cache=app.state.vector_store_cache, disk_cache=app.state.vector_store_disk_cache
+    )
+
+async def load_chat_context(username: str, request: ChatRequest):
+    """
+    Resolves the request's chat session, creating one if none was given, and rebuilds the
+    conversation from its stored messages not yet covered by the rolling summary, plus the new turn.
+    Returns (session_id, messages, summary).
+    """
+    if request.session_id:
+        session = await run_blocking(database.get_chat_session, app.state.db, request.session_id)
+        if not session or session["owner_id"] != username:
+            raise HTTPException(status_code=404, detail="Chat session not found.")
+        session_id = request.session_id
+        history = await run_blocking(database.get_chat_messages, app.state.db, session_id, app.state.chat_context_messages)
+        summarized_through_seq = session.get("summarized_through_seq", -1)
+        history = [m for m in history if m["seq"] > summarized_through_seq]
+        summary = session.get("summary")
+    else:
+        session_id = await run_blocking(database.create_chat_session, app.state.db, username)
+        history, summary = [], None
+    messages = [{"role": m["role"], "content": m["content"]} for m in history]
+    messages.append({"role": "user", "content": request.message})
+    return session_id, messages, summary
+
+async def save_chat_turn(session_id: str, user_message: str, ai_response: str, provider: str):
+    with metrics.stage("persist"):
+        await run_blocking(database.append_chat_messages, app.state.db, session_id, [
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": ai_response},
+        ])
+    # Fold older turns into the summary off the request path, at most once at a time per session.
+    if session_id not in app.state.summarizing_sessions:
+        app.state.summarizing_sessions.add(session_id)
+        task = asyncio.create_task(refresh_chat_summary(session_id, provider))
+        app.state.background_tasks.add(task)
+        task.add_done_callback(app.state.background_tasks.discard)
+
+async def refresh_chat_summary(session_id: str, provider: str):
+    """
+    Replaces the oldest unsummarized turns with an updated rolling summary once they take up
+    too much of the provider's context budget, or too much of the history loaded per turn.
+    """
+    metrics.detach()
+    try:
+        session = await run_blocking(database.get_chat_session, app.state.db, session_id)
+        history = await run_blocking(database.get_chat_messages, app.state.db, session_id, app.state.chat_context_messages)
+        history = [m for m in history if m["seq"] > session.get("summarized_through_seq", -1)]
+        model = LLM_PROVIDERS[provider]["model"]
+        history_budget = int(LLM_PROVIDERS[provider]["context_budget_tokens"] * chat_context.SUMMARY_TRIGGER_FRACTION)
+        max_messages = app.state.chat_context_messages // 2
+        if len(history) <= max_messages and chat_context.count_message_tokens(history, model) <= history_budget:
+            return
+
+        # Keep the newest turns verbatim, within half of both limits, and summarize the rest.
+        recent = history[-max(max_messages // 2, 1):]
+        _, kept = chat_context.fit_history(recent, history_budget // 2, model)
+        dropped = history[:len(history) - len(kept)]
+        if not dropped:
+            return
+        summary = await ai.get_ai_response(
+            provider=provider,
+            system_prompt="You write concise, factual summaries of tutoring conversations.",
+            messages=[{"role": "user", "content": chat_context.build_summary_prompt(session.get("summary"), dropped)}],
+            use_rag=False,
+            clients=app.state.llm_clients
+        )
+        if "An error occurred" in summary:
+            return
+        await run_blocking(database.update_chat_summary, app.state.db, session_id, summary, dropped[-1]["seq"])
+    except Exception as e:
+        print(f"Updating the summary of chat session {session_id} failed: {e}")
+    finally:
+        app.state.summarizing_sessions.discard(session_id)
+
+async def lookup_cached_response(request: ChatRequest, messages: List[Dict], system_prompt: str, vector_store):
+    """
+    Looks the request up in the response cache.
+    Returns (cache_keys, cached_response, query_vector); cache_keys is None when caching is off for this request.
+    """
+    cache = app.state.response_cache
+    if cache is None or request.bypass_cache:
+        return None, None, None
+    cache_keys = cache.make_keys(
+        request.llm_provider,
+        LLM_PROVIDERS.get(request.llm_provider, {}).get("model"),
+        system_prompt,
+        getattr(vector_store, "index_version", None),
+        messages,
+    )
+    cached_response, query_vector = await cache.lookup(cache_keys, app.state.embeddings.aembed_query)
+    return cache_keys, cached_response, query_vector
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest, current_user: User = Depends(get_current_user)):
-    vector_store = None
-    if request.rag_scope:
-        gcs_path_prefix = f"vector_stores/{current_user.username}/{request.rag_scope.scope_id}"
-        vector_store = rag.load_vector_store_from_gcs(app.state.gcs_bucket_name, gcs_path_prefix, app.state.embeddings)
-
-    ai_response = ai.get_ai_response(
+    if request.llm_provider not in LLM_PROVIDERS:
+        raise HTTPException(status_code=400, detail=f"Unsupported LLM provider: {request.llm_provider}")
+    with metrics.stage("session_load"):
+        session_id, messages, summary = await load_chat_context(current_user.username, request)
+    with metrics.stage("vector_store_load"):
+        vector_store = await load_rag_vector_store(current_user.username, request.rag_scope)
+    system_prompt = f"{request.persona} at {request.educational_level} level"
+
+    with metrics.stage("cache_lookup"):
+        cache_keys, cached_response, query_vector = await lookup_cached_response(request, messages, system_prompt, vector_store)
+    if cached_response is not None:
+        await save_chat_turn(session_id, request.message, cached_response, request.llm_provider)
+        return ChatResponse(role="assistant", content=cached_response, session_id=session_id)
+
+    ai_response = await ai.get_ai_response(
         provider=request.llm_provider,
-        system_prompt=f"{request.persona} at {request.educational_level} level",
-        messages=request.messages,
+        system_prompt=system_prompt,
+        messages=messages,
         vector_store=vector_store,
-        use_rag=bool(request.rag_scope)
+        use_rag=bool(request.rag_scope),
+        clients=app.state.llm_clients,
+        summary=summary
     )
     if "An error occurred" in ai_response:
         raise HTTPException(status_code=500, detail=ai_response)
-    return ChatResponse(role="assistant", content=ai_response)
+    if cache_keys:
+        app.state.response_cache.put(cache_keys, ai_response, query_vector)
+    await save_chat_turn(session_id, request.message, ai_response, request.llm_provider)
+    return ChatResponse(role="assistant", content=ai_response, session_id=session_id)
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, current_user: User = Depends(get_current_user)):
+    """
+    Streams the assistant's reply as server-sent events.
+    Each `message` event carries {"content": "<text piece>"}; the stream ends with a `done` event
+    carrying {"session_id": ...} or an `error` event. The turn is stored only if it completes.
+    """
+    if request.llm_provider not in LLM_PROVIDERS:
+        raise HTTPException(status_code=400, detail=f"Unsupported LLM provider: {request.llm_provider}")
+    with metrics.stage("session_load"):
+        session_id, messages, summary = await load_chat_context(current_user.username, request)
+    with metrics.stage("vector_store_load"):
+        vector_store = await load_rag_vector_store(current_user.username, request.rag_scope)
+    system_prompt = f"{request.persona} at {request.educational_level} level"
+    with metrics.stage("cache_lookup"):
+        cache_keys, cached_response, query_vector = await lookup_cached_response(request, messages, system_prompt, vector_store)
+    done_event = f"event: done\ndata: {json.dumps({'session_id': session_id})}\n\n"
+
+    async def event_stream():
+        if cached_response is not None:
+            yield f"data: {json.dumps({'content': cached_response})}\n\n"
+            await save_chat_turn(session_id, request.message, cached_response, request.llm_provider)
+            yield done_event
+            return
+        pieces = []
+        try:
+            async for piece in ai.stream_ai_response(
+                provider=request.llm_provider,
+                system_prompt=system_prompt,
+                messages=messages,
+                vector_store=vector_store,
+                use_rag=bool(request.rag_scope),
+                clients=app.state.llm_clients,
+                summary=summary
+            ):
+                pieces.append(piece)
+                yield f"data: {json.dumps({'content': piece})}\n\n"
+            ai_response = "".join(pieces)
+            await save_chat_turn(session_id, request.message, ai_response, request.llm_provider)
+        except Exception as e:
+            print(f"Error streaming from {request.llm_provider} API: {e}")
+            detail = f"An error occurred while communicating with the {request.llm_provider} API. Please check the backend logs."
+            yield f"event: error\ndata: {json.dumps({'detail': detail})}\n\n"
+            return
+        if cache_keys:
+            app.state.response_cache.put(cache_keys, ai_response, query_vector)
+        yield done_event
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Chat-Session-Id": session_id},
+    )
+
+@app.post("/chat/sessions", response_model=ChatSessionResponse)
+async def create_chat_session_endpoint(current_user: User = Depends(get_current_user)):
+    session_id = await run_blocking(database.create_chat_session, app.state.db, current_user.username)
+    return ChatSessionResponse(id=session_id, message_count=0)
+
+@app.get("/chat/sessions", response_model=List[ChatSessionResponse])
+async def get_chat_sessions_endpoint(current_user: User = Depends(get_current_user)):
+    return await run_blocking(database.get_chat_sessions_for_user, app.state.db, current_user.username)
+
+@app.get("/chat/sessions/{session_id}/messages", response_model=ChatMessagesPage)
+async def get_chat_messages_endpoint(session_id: str, limit: int = Query(50, ge=1, le=200), before: Optional[int] = None,
+                                     current_user: User = Depends(get_current_user)):
+    """Pages backwards through a session's messages; each page is in chronological order."""
+    session = await run_blocking(database.get_chat_session, app.state.db, session_id)
+    if not session or session["owner_id"] != current_user.username:
+        raise HTTPException(status_code=404, detail="Chat session not found.")
+    messages = await run_blocking(database.get_chat_messages, app.state.db, session_id, limit, before)
+    next_before = messages[0]["seq"] if messages and messages[0]["seq"] > 0 else None
+    return ChatMessagesPage(messages=messages, next_before=next_before)
 
 # --- Grading Endpoints ---
 @app.post("/submissions/grade", response_model=GradeResponse)
 async def grade_submission_endpoint(request: SubmissionRequest, current_user: User = Depends(get_current_user)):
-    assignment = database.get_assignment(app.state.db, request.assignment_id)
+    with metrics.stage("assignment_load"):
+        assignment = await run_blocking(database.get_assignment, app.state.db, request.assignment_id)
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found.")
 
-    grading_prompt = f"""
-    You are an expert teaching assistant. Your task is to grade a student's submission.
-    Provide a numerical score out of 100 and constructive feedback.
-    Return your response as a JSON object with two keys: "grade" (an integer) and "feedback" (a string).
+    try:
+        grade, feedback = await grading.grade_submission(assignment['description'], request.content, app.state.llm_clients)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-    Original Assignment Description:
-    ---
-    {assignment['description']}
-    ---
+    with metrics.stage("persist"):
+        await run_blocking(database.save_submission, app.state.db, request.assignment_id, current_user.username, request.content, grade, feedback)
+    return GradeResponse(grade=grade, feedback=feedback)
 
-    Student's Submission:
-    ---
-    {request.content}
-    ---
-    """
+async def grade_and_save_submissions(submissions: List[Dict], assignments: Dict[str, Dict]) -> List[Dict]:
+    """Grades submissions concurrently and saves the successful ones in batched writes."""
+    results = await grading.grade_submissions(submissions, assignments, app.state.llm_clients)
+    graded = [
+        {**submission, "grade": result["grade"], "feedback": result["feedback"]}
+        for submission, result in zip(submissions, results) if result["error"] is None
+    ]
+    if graded:
+        with metrics.stage("persist"):
+            await run_blocking(database.save_submissions, app.state.db, graded)
+    return results
+
+@app.post("/submissions/grade/batch", response_model=List[BatchGradeResult])
+async def grade_submissions_batch_endpoint(request: BatchSubmissionRequest, current_user: User = Depends(get_current_user)):
+    """Grades several of the current user's submissions at once. Failures are reported per submission."""
+    assignment_ids = [submission.assignment_id for submission in request.submissions]
+    with metrics.stage("assignment_load"):
+        assignments = await run_blocking(database.get_assignments, app.state.db, assignment_ids)
+    submissions = [
+        {"assignment_id": submission.assignment_id, "student_id": current_user.username, "content": submission.content}
+        for submission in request.submissions
+    ]
+    return await grade_and_save_submissions(submissions, assignments)
+
+@app.post("/assignments/{assignment_id}/grade-all", response_model=List[BatchGradeResult])
+async def grade_all_submissions_endpoint(assignment_id: str, request: ClassGradingRequest, educator: str = Depends(get_current_educator)):
+    """Grades a whole class's submissions for one of the educator's assignments."""
+    with metrics.stage("assignment_load"):
+        assignment = await run_blocking(database.get_assignment, app.state.db, assignment_id)
+    if not assignment or assignment.get("educator_id") != educator:
+        raise HTTPException(status_code=404, detail="Assignment not found.")
+    submissions = [
+        {"assignment_id": assignment_id, "student_id": submission.student_id, "content": submission.content}
+        for submission in request.submissions
+    ]
+    return await grade_and_save_submissions(submissions, {assignment_id: assignment})
 
-    ai_response_str = ai.get_ai_response(
-        provider="TogetherAI",
-        system_prompt="You are a fair and helpful grading assistant who provides clear, actionable feedback. You always respond in JSON format.",
-        messages=[{"role": "user", "content": grading_prompt}],
-        use_rag=False
+# --- Educator-Specific Endpoints ---
+@app.post("/assignments", response_model=AssignmentResponse)
+async def create_assignment_endpoint(request: AssignmentRequest, educator: str = Depends(get_current_educator)):
+    """
+    Creates an assignment and assigns it to the educator's class.
+    Rosters that fit in one write batch are assigned before returning; larger ones are assigned in the background.
+    """
+    assignment_id = await run_blocking(
+        database.create_assignment, app.state.db, educator, request.title, request.description, request.due_date, assign=False
     )
-
+    students = await run_blocking(database.get_students_for_educator, app.state.db, educator)
+    if len(students) <= app.state.assignment_inline_fanout_max:
+        await run_blocking(database.assign_to_students, app.state.db, assignment_id, students)
+    else:
+        task = asyncio.create_task(assign_to_students_in_background(assignment_id, students))
+        app.state.background_tasks.add(task)
+        task.add_done_callback(app.state.background_tasks.discard)
+    return AssignmentResponse(id=assignment_id, **request.model_dump())
+
+async def assign_to_students_in_background(assignment_id: str, students: List[str]):
     try:
-        grade_data = json.loads(ai_response_str)
-        grade = int(grade_data.get("grade", 0))
-        feedback = grade_data.get("feedback", "No feedback provided.")
-    except (json.JSONDecodeError, TypeError, ValueError):
-        raise HTTPException(status_code=500, detail="AI returned an invalid format for the grade.")
+        await run_blocking(database.assign_to_students, app.state.db, assignment_id, students)
+        print(f"Assigned {assignment_id} to {len(students)} students.")
+    except Exception as e:
+        print(f"Assigning {assignment_id} to {len(students)} students failed: {e}")
 
-    database.save_submission(app.state.db, request.assignment_id, current_user.username, request.content, grade, feedback)
-    return GradeResponse(grade=grade, feedback=feedback)
-
-# --- Educator-Specific Endpoints ---
 @app.get("/assignments/educator", response_model=List[AssignmentResponse])
 async def get_educator_assignments_endpoint(educator: str = Depends(get_current_educator)):
-    assignments = database.get_assignments_for_educator(app.state.db, educator)
+    assignments = await run_blocking(database.get_assignments_for_educator, app.state.db, educator)
     return assignments
 
 @app.post("/attendance")
 async def mark_attendance_endpoint(request: AttendanceRequest, educator: str = Depends(get_current_educator)):
-    database.mark_attendance(app.state.db, educator, request.date, request.present_students)
+    await run_blocking(database.mark_attendance, app.state.db, educator, request.date, request.present_students)
     return {"message": f"Attendance for {request.date} recorded successfully."}
 
 # --- Utility Endpoints ---
 @app.get("/storage-usage", response_model=Dict[str, float])
 async def get_storage_usage_endpoint(current_user: User = Depends(get_current_user)):
-    usage_mb = rag.get_user_storage_usage_mb(app.state.gcs_bucket_name, current_user.username)
+    usage_bytes = await run_blocking(database.get_storage_usage_bytes, app.state.db, current_user.username)
+    usage_mb = usage_bytes / (1024 * 1024)
     return {"usage_mb": usage_mb, "limit_mb": app.state.storage_limit_mb}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics_endpoint():
+    """Request and stage duration histograms in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache-stats", response_model=Dict[str, Dict[str, float]])
+async def get_cache_stats_endpoint(current_user: User = Depends(get_current_user)):
+    """Reports cache counters so the cache budgets can be sized."""
+    stats = {"vector_stores": app.state.vector_store_cache.stats(), "users": app.state.user_cache.stats()}
+    if hasattr(app.state.embeddings, "stats"):
+        stats["embeddings"] = app.state.embeddings.stats()
+    if app.state.response_cache is not None:
+        stats["responses"] = app.state.response_cache.stats()
+    return stats
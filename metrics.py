@@ -0,0 +1,126 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# --- Configuration ---
+# When disabled, stage() returns immediately and main.py adds no timing middleware.
+ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """A labelled histogram rendered in the Prometheus text exposition format."""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: Tuple[str, ...], value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            # Values above the largest bucket only count towards +Inf, which equals the total count.
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            labels = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram(
+    "edu_request_duration_seconds", "Time until a response is fully sent, per endpoint.", ("endpoint", "method", "status")
+)
+STAGE_SECONDS = Histogram(
+    "edu_request_stage_duration_seconds", "Time spent in each stage of a request.", ("endpoint", "stage", "provider")
+)
+
+# Recall@k of each newly built vector index against exact flat search, by index format.
+INDEX_RECALL = Histogram(
+    "edu_vector_index_recall", "Recall of newly built vector indexes against flat search.", ("index_type",),
+    buckets=(0.5, 0.7, 0.8, 0.9, 0.95, 0.98, 0.99, 1.0),
+)
+
+
+# --- Per-Request Timing ---
+class RequestTiming:
+    """The stages timed during one request. `scope` is the ASGI scope, which names the matched route."""
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.stages: Dict[str, float] = {}
+
+    @property
+    def endpoint(self) -> str:
+        route = self.scope.get("route")
+        return getattr(route, "path", "unmatched")
+
+    def add(self, stage: str, provider: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.observe((self.endpoint, stage, provider), seconds)
+
+    def server_timing(self, total_s: float) -> str:
+        """Formats the stages as a Server-Timing header value, in milliseconds."""
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={total_s * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_current_timing: contextvars.ContextVar[Optional[RequestTiming]] = contextvars.ContextVar("request_timing", default=None)
+
+
+def start_request(scope: dict) -> RequestTiming:
+    timing = RequestTiming(scope)
+    _current_timing.set(timing)
+    return timing
+
+
+def detach():
+    """Stops attributing stages to the request, for background tasks that outlive it."""
+    _current_timing.set(None)
+
+
+@contextmanager
+def stage(name: str, provider: str = ""):
+    """Times the enclosed block as a stage of the current request. Outside a request it does nothing."""
+    timing = _current_timing.get() if ENABLED else None
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, provider, time.perf_counter() - start)
+
+
+def render() -> str:
+    return "\n".join(REQUEST_SECONDS.render() + STAGE_SECONDS.render() + INDEX_RECALL.render()) + "\n"
@@ -1,6 +1,10 @@
-from pydantic import BaseModel
+import os
+from pydantic import BaseModel, Field
 from typing import List, Dict, Optional
 
+# Submissions accepted per batch grading request; each one is an LLM call held in memory until the batch finishes.
+GRADING_MAX_SUBMISSIONS = int(os.getenv("GRADING_MAX_SUBMISSIONS", 200))
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -26,23 +30,47 @@ class ChatMessage(BaseModel):
     content: str
 
 class RAGScope(BaseModel):
-    scope_type: str
+    scope_type: str  # "document" (scope_id is a doc id), "category" (scope_id is the category) or "library"
     scope_id: str
 
 class ChatRequest(BaseModel):
-    messages: List[ChatMessage]
+    message: str  # The new user turn; earlier turns are loaded from the session
+    session_id: Optional[str] = None  # Omit to start a new session
     persona: str
     educational_level: str
     llm_provider: str
     rag_scope: Optional[RAGScope] = None
+    bypass_cache: bool = False
 
 class ChatResponse(BaseModel):
     role: str
     content: str
+    session_id: str
+
+class ChatSessionResponse(BaseModel):
+    id: str
+    message_count: int
+
+class ChatHistoryMessage(ChatMessage):
+    seq: int
+
+class ChatMessagesPage(BaseModel):
+    messages: List[ChatHistoryMessage]
+    next_before: Optional[int] = None  # Pass as `before` to fetch the previous page; None when there is none
 
 class UploadResponse(BaseModel):
     message: str
     doc_id: str # Added doc_id as it was in the main.py upload endpoint
+    job_id: str
+
+class IngestionJobResponse(BaseModel):
+    id: str
+    status: str
+    stage: str
+    progress: float
+    doc_id: str
+    filename: str
+    error: Optional[str] = None
 
 class AssignmentRequest(BaseModel):
     title: str
@@ -60,6 +88,23 @@ class GradeResponse(BaseModel):
     grade: int
     feedback: str
 
+class BatchSubmissionRequest(BaseModel):
+    submissions: List[SubmissionRequest] = Field(..., max_length=GRADING_MAX_SUBMISSIONS)
+
+class ClassSubmission(BaseModel):
+    student_id: str
+    content: str
+
+class ClassGradingRequest(BaseModel):
+    submissions: List[ClassSubmission] = Field(..., max_length=GRADING_MAX_SUBMISSIONS)
+
+class BatchGradeResult(BaseModel):
+    assignment_id: str
+    student_id: str
+    grade: Optional[int] = None
+    feedback: Optional[str] = None
+    error: Optional[str] = None
+
 class SchoolRequest(BaseModel):
     name: str
 
@@ -0,0 +1,21 @@
+# Kept free of heavy imports: these functions run in ingestion's spawned parser processes.
+# pypdf is imported on first use, so the API process only loads it once a PDF is ingested.
+from typing import List
+
+from langchain_core.documents import Document
+
+
+def count_pdf_pages(path: str) -> int:
+    """Returns the number of pages in a PDF without extracting any text."""
+    from pypdf import PdfReader
+    return len(PdfReader(path).pages)
+
+
+def parse_pdf_pages(path: str, source: str, start: int, stop: int) -> List[Document]:
+    """Extracts pages [start, stop) of a PDF as one Document per page, like PyPDFLoader."""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return [
+        Document(page_content=reader.pages[i].extract_text() or "", metadata={"source": source, "page": i})
+        for i in range(start, min(stop, len(reader.pages)))
+    ]
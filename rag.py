@@ -1,78 +1,275 @@
-from langchain_community.vectorstores import FAISS
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from google.cloud import storage
-import tempfile
+import asyncio
+import heapq
+import inspect
+import numpy as np
 import os
-from pathlib import Path
+import pickle
 
-def create_vector_store(docs, embeddings):
-    """Creates a FAISS vector store from documents."""
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    texts = text_splitter.split_documents(docs)
-    vector_store = FAISS.from_documents(texts, embeddings)
+import gcs_transfer
+import metrics
+import vector_index
+from vector_cache import version_digest
+
+# FAISS and the text splitter take over a second to import, so they are imported where first used
+# rather than when the API process starts.
+
+def preload():
+    """Imports FAISS ahead of the first vector store load."""
+    from langchain_community.vectorstores import FAISS  # noqa: F401
+
+def _text_splitter():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+
+def create_vector_store(docs, embeddings, progress=None):
+    """
+    Creates a FAISS vector store from documents, with the index format chosen for its size.
+    If given, `progress(done, total)` is called as chunks are embedded.
+    """
+    from langchain_community.vectorstores import FAISS
+    texts = _text_splitter().split_documents(docs)
+    # Only the batching embedders report progress; plain LangChain embeddings are used as-is.
+    if progress is None or "progress" not in inspect.signature(embeddings.embed_documents).parameters:
+        return compact_vector_store(FAISS.from_documents(texts, embeddings))
+
+    contents = [text.page_content for text in texts]
+    vectors = embeddings.embed_documents(contents, progress=progress)
+    return compact_vector_store(FAISS.from_embeddings(
+        list(zip(contents, vectors)), embeddings, metadatas=[text.metadata for text in texts]
+    ))
+
+# Chunks embedded per step when the embeddings client does not say how many it embeds concurrently.
+DEFAULT_EMBEDDING_STEP_CHUNKS = 512
+
+def _embedding_step_chunks(embeddings) -> int:
+    """Chunks to embed at once so a batching client fills all of its concurrent requests."""
+    client = getattr(embeddings, "underlying", embeddings)  # Looks through CachedEmbeddings
+    batch_size, max_concurrency = getattr(client, "batch_size", None), getattr(client, "max_concurrency", None)
+    if batch_size and max_concurrency:
+        return batch_size * max_concurrency
+    return DEFAULT_EMBEDDING_STEP_CHUNKS
+
+def create_vector_store_incrementally(windows, embeddings, progress=None):
+    """
+    Creates a FAISS vector store from an iterable of (documents, done, total) windows.
+    Windows are split as they are read and their chunks embedded in steps of about
+    batch_size * max_concurrency, so every embedding request slot is in use while memory holds
+    the growing index plus at most one step of chunks rather than the whole document.
+    The finished flat index is then rebuilt in the format chosen for its size.
+    """
+    from langchain_community.vectorstores import FAISS
+    text_splitter = _text_splitter()
+    step_chunks = _embedding_step_chunks(embeddings)
+    vector_store = None
+    pending = []
+    pending_progress = None
+
+    def embed_pending():
+        nonlocal vector_store
+        contents = [text.page_content for text in pending]
+        text_embeddings = list(zip(contents, embeddings.embed_documents(contents)))
+        metadatas = [text.metadata for text in pending]
+        if vector_store is None:
+            vector_store = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas)
+        else:
+            vector_store.add_embeddings(text_embeddings, metadatas=metadatas)
+        pending.clear()
+
+    for docs, done, total in windows:
+        pending.extend(text_splitter.split_documents(docs))
+        pending_progress = (done, total)
+        if len(pending) >= step_chunks:
+            embed_pending()
+            if progress:
+                progress(done, total)
+            pending_progress = None
+
+    if pending:
+        embed_pending()
+    if progress and pending_progress:
+        progress(*pending_progress)
+
+    if vector_store is None:
+        raise ValueError("The document contains no extractable text.")
+    return compact_vector_store(vector_store)
+
+def compact_vector_store(vector_store, index_type=None):
+    """
+    Replaces a store's flat index with the format chosen for its chunk count (see vector_index).
+    The format, size and recall against flat search are kept on the store as `index_stats`.
+    """
+    vector_store.index, vector_store.index_stats = vector_index.compact(vector_store.index, index_type)
+    stats = vector_store.index_stats
+    recall = stats[f"recall_at_{vector_index.RECALL_K}"]
+    metrics.INDEX_RECALL.observe((stats["index_type"],), recall)
+    print(f"Built {stats['index_type']} index over {stats['chunks']} chunks "
+          f"({stats['index_bytes'] / 1024:.0f} KB, recall@{vector_index.RECALL_K} {recall:.3f})")
     return vector_store
 
-def save_vector_store_to_gcs(vector_store, bucket_name, destination_blob_prefix):
-    """Saves a FAISS vector store to a GCS bucket."""
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
+def serialize_vector_store(vector_store) -> dict:
+    """Serializes a FAISS vector store into its index file and a compact docstore file, held in memory."""
+    import faiss
+    return {
+        "index.faiss": faiss.serialize_index(vector_store.index).tobytes(),
+        vector_index.DOCSTORE_FILE: vector_index.serialize_docstore(
+            vector_store.docstore, vector_store.index_to_docstore_id, getattr(vector_store, "index_stats", None)
+        ),
+    }
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Save the FAISS index to a temporary local directory
-            vector_store.save_local(temp_dir)
+def deserialize_vector_store(files: dict, embeddings):
+    """Rebuilds a FAISS vector store from in-memory index files."""
+    import faiss
+    index = faiss.deserialize_index(np.frombuffer(files["index.faiss"], dtype=np.uint8))
+    return _with_docstore(index, files.get(vector_index.DOCSTORE_FILE), files.get("index.pkl"), embeddings)
 
-            # Upload each file in the temp directory to GCS
-            for file_path in Path(temp_dir).rglob('*'):
-                if file_path.is_file():
-                    blob_name = f"{destination_blob_prefix}/{file_path.name}"
-                    blob = bucket.blob(blob_name)
-                    blob.upload_from_filename(str(file_path))
+def _with_docstore(index, docstore_data, legacy_pickle, embeddings):
+    # Stores saved before the compact docstore format carry a pickled docstore instead.
+    from langchain_community.vectorstores import FAISS
+    if docstore_data is not None:
+        docstore, index_to_docstore_id, stats = vector_index.deserialize_docstore(docstore_data)
+    else:
+        (docstore, index_to_docstore_id), stats = pickle.loads(legacy_pickle), {}
+    vector_store = FAISS(embeddings, index, docstore, index_to_docstore_id)
+    vector_store.index_stats = stats
+    return vector_store
 
+def save_vector_store_to_gcs(vector_store, bucket_name, destination_blob_prefix) -> int:
+    """Saves a FAISS vector store to a GCS bucket. Returns the number of bytes stored, or 0 on failure."""
+    try:
+        files = serialize_vector_store(vector_store)
+        gcs_transfer.upload_bytes(bucket_name, destination_blob_prefix, files)
         print(f"Vector store saved to GCS bucket '{bucket_name}' with prefix '{destination_blob_prefix}'")
-        return True
+        return sum(len(data) for data in files.values())
     except Exception as e:
         print(f"Failed to save vector store to GCS: {e}")
-        return False
-
-def load_vector_store_from_gcs(bucket_name, source_blob_prefix, embeddings):
-    """Loads a FAISS vector store from a GCS bucket."""
-    try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
+        return 0
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download all parts of the FAISS index from GCS
+def delete_vector_store_from_gcs(bucket_name, blob_prefix) -> int:
+    """Deletes every blob of a vector store. Returns the number of bytes freed."""
+    blobs = gcs_transfer.list_blobs(bucket_name, blob_prefix)
+    freed_bytes = sum(blob.size or 0 for blob in blobs)
+    for blob in blobs:
+        blob.delete()
+    return freed_bytes
 
-            blobs = list(storage_client.list_blobs(bucket_name, prefix=source_blob_prefix))
-            if not blobs:
-                return None # No document found for this user/scope
+def load_vector_store_from_gcs(bucket_name, source_blob_prefix, embeddings, cache=None, disk_cache=None):
+    """
+    Loads a FAISS vector store from a GCS bucket.
+    If a VectorStoreCache is given, the download is skipped while the blob generations are unchanged,
+    and a store whose generations were checked within the cache's freshness window skips the listing too.
+    If a VectorStoreDiskCache is given, blobs are kept on local disk and the index is memory-mapped.
+    """
+    if cache is not None:
+        vector_store = cache.get_recent(source_blob_prefix)
+        if vector_store is not None:
+            return vector_store
+    try:
+        blobs = gcs_transfer.list_blobs(bucket_name, source_blob_prefix)
+        if not blobs:
+            return None # No document found for this user/scope
 
+        version = tuple(sorted((blob.name, blob.generation) for blob in blobs))
 
-            for blob in blobs:
-                file_name = os.path.basename(blob.name)
-                destination_file_path = os.path.join(temp_dir, file_name)
-                blob.download_to_filename(destination_file_path)
+        def load():
+            if disk_cache is None:
+                vector_store = deserialize_vector_store(gcs_transfer.download_bytes(blobs), embeddings)
+                print(f"Vector store loaded from GCS bucket '{bucket_name}'")
+            else:
+                local_dir = disk_cache.get_local_dir(
+                    source_blob_prefix, version, lambda target_dir: gcs_transfer.download_to_dir(blobs, target_dir)
+                )
+                vector_store = _load_vector_store_mmap(local_dir, embeddings)
+            # Lets callers key derived data (e.g. cached responses) on the exact index contents.
+            vector_store.index_version = version_digest(version)
+            return vector_store
 
+        if cache is None:
+            return load()
 
-            # Load the FAISS index from the temporary directory
-            vector_store = FAISS.load_local(temp_dir, embeddings, allow_dangerous_deserialization=True)
-            print(f"Vector store loaded from GCS bucket '{bucket_name}'")
-            return vector_store
+        # A memory-mapped index lives in the shared page cache, so only the docstore counts against the heap budget.
+        size_bytes = sum(
+            (blob.size or 0) * (vector_index.DOCSTORE_EXPANSION if blob.name.endswith(vector_index.DOCSTORE_FILE) else 1)
+            for blob in blobs
+            if disk_cache is None or not blob.name.endswith(".faiss")
+        )
+        return cache.get_or_load(source_blob_prefix, version, size_bytes, load)
 
     except Exception as e:
         print(f"Failed to load vector store from GCS: {e}")
         return None
 
+def _load_vector_store_mmap(local_dir, embeddings):
+    """Loads a FAISS vector store from disk with index.faiss memory-mapped read-only."""
+    import faiss
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    index = faiss.read_index(os.path.join(local_dir, "index.faiss"), mmap_flag | faiss.IO_FLAG_READ_ONLY)
+    files = {}
+    for name in (vector_index.DOCSTORE_FILE, "index.pkl"):
+        path = os.path.join(local_dir, name)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                files[name] = f.read()
+    return _with_docstore(index, files.get(vector_index.DOCSTORE_FILE), files.get("index.pkl"), embeddings)
+
+
+class MultiVectorStore:
+    """
+    Searches several per-document vector stores as one.
+
+    The query is embedded once, every store is searched in parallel for its own top k, and the
+    results are merged into a global top k by distance. All stores are built by this module with
+    the same embedding model and L2 index, so their distances are directly comparable.
+    """
+
+    def __init__(self, vector_stores, embeddings):
+        self.vector_stores = list(vector_stores)
+        self.embeddings = embeddings
+        # Changes whenever any member index changes, so cached responses keyed on it stay correct.
+        self.index_version = version_digest(tuple(sorted(getattr(store, "index_version", "") for store in self.vector_stores)))
+
+    def similarity_search_with_score(self, query: str, k: int = 4):
+        embedding = self.embeddings.embed_query(query)
+        results = [store.similarity_search_with_score_by_vector(embedding, k) for store in self.vector_stores]
+        return _merge_top_k(results, k)
+
+    def similarity_search(self, query: str, k: int = 4):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    async def asimilarity_search_with_score(self, query: str, k: int = 4):
+        embedding = await self.embeddings.aembed_query(query)
+        return await self.asimilarity_search_with_score_by_vector(embedding, k)
+
+    async def asimilarity_search_with_score_by_vector(self, embedding, k: int = 4):
+        loop = asyncio.get_running_loop()
+        # FAISS releases the GIL while searching, so the per-store searches overlap in the default executor.
+        results = await asyncio.gather(*(
+            loop.run_in_executor(None, store.similarity_search_with_score_by_vector, embedding, k)
+            for store in self.vector_stores
+        ))
+        return _merge_top_k(results, k)
+
+    async def asimilarity_search(self, query: str, k: int = 4):
+        return [doc for doc, _ in await self.asimilarity_search_with_score(query, k)]
+
+    async def asimilarity_search_by_vector(self, embedding, k: int = 4):
+        return [doc for doc, _ in await self.asimilarity_search_with_score_by_vector(embedding, k)]
+
+def _merge_top_k(results, k: int):
+    return heapq.nsmallest(k, (pair for store_results in results for pair in store_results), key=lambda pair: pair[1])
+
+def get_storage_usage_by_user(bucket_name: str) -> dict:
+    """Sums blob sizes under vector_stores/ per username, in bytes. Used to reconcile the usage counters."""
+    usage = {}
+    for blob in gcs_transfer.list_blobs(bucket_name, "vector_stores/"):
+        username = blob.name.split("/")[1]
+        usage[username] = usage.get(username, 0) + (blob.size or 0)
+    return usage
 
 def get_user_storage_usage_mb(bucket_name: str, username: str) -> float:
     """Calculates the total storage size in MB for a given user's folder in GCS."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
     prefix = f"vector_stores/{username}/"
-    blobs = storage_client.list_blobs(bucket, prefix=prefix)
+    blobs = gcs_transfer.list_blobs(bucket_name, prefix)
 
     total_size_bytes = sum(blob.size for blob in blobs)
     total_size_mb = total_size_bytes / (1024 * 1024)
     return total_size_mb
-
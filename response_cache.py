@@ -0,0 +1,151 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+
+import numpy as np
+
+
+class CacheKeys(NamedTuple):
+    context_key: str  # provider, model, system prompt, RAG index version and earlier turns
+    exact_key: str  # context_key plus the normalized question
+    query_text: str  # the normalized question, embedded for similarity lookups
+
+
+def normalize_text(text: str) -> str:
+    """Lowercases and collapses whitespace so trivially different phrasings share a key."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class ResponseCache:
+    """
+    A TTL- and size-bounded cache of LLM chat responses.
+
+    Lookups first try an exact match on the normalized conversation tail. If a similarity
+    threshold is set, they then try the closest cached question, by cosine similarity of
+    the question embeddings, among entries that share the same context.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float, tail_turns: int = 3, similarity_threshold: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.tail_turns = tail_turns
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # exact_key -> (context_key, response, vector, expires_at)
+        self._by_context = {}  # context_key -> set of exact_keys
+        self._lock = threading.Lock()
+
+    def make_keys(self, provider: str, model: str, system_prompt: str, rag_version: Optional[str], messages: List[dict]) -> CacheKeys:
+        """Builds the cache keys for a chat request from its last `tail_turns` messages."""
+        tail = [(m["role"], normalize_text(m["content"])) for m in messages[-self.tail_turns:]]
+        context = json.dumps([provider, model, normalize_text(system_prompt), rag_version, tail[:-1]])
+        context_key = hashlib.sha256(context.encode("utf-8")).hexdigest()
+        query_text = tail[-1][1]
+        exact_key = hashlib.sha256(f"{context_key}\n{query_text}".encode("utf-8")).hexdigest()
+        return CacheKeys(context_key, exact_key, query_text)
+
+    async def lookup(self, keys: CacheKeys, embed_query=None):
+        """
+        Returns (response, query_vector). The response is None on a miss.
+        `embed_query` is an async callable used for the similarity lookup after an exact miss;
+        the vector is returned so the caller can store it with the fresh response.
+        """
+        response = self._get_exact(keys)
+        if response is not None:
+            return response, None
+
+        vector = None
+        if self.similarity_threshold and embed_query is not None:
+            try:
+                vector = await embed_query(keys.query_text)
+            except Exception as e:
+                print(f"Response cache similarity lookup skipped: {e}")
+            if vector is not None:
+                response = self._get_similar(keys, vector)
+                if response is not None:
+                    return response, vector
+
+        with self._lock:
+            self.misses += 1
+        return None, vector
+
+    def _get_exact(self, keys: CacheKeys) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(keys.exact_key)
+            if entry and entry[3] > time.monotonic():
+                self._entries.move_to_end(keys.exact_key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                self._remove(keys.exact_key)
+            return None
+
+    def _get_similar(self, keys: CacheKeys, vector: List[float]) -> Optional[str]:
+        query = _unit(vector)
+        now = time.monotonic()
+        best_key, best_score = None, self.similarity_threshold
+        with self._lock:
+            for exact_key in list(self._by_context.get(keys.context_key, ())):
+                _, _, cached_vector, expires_at = self._entries[exact_key]
+                if expires_at <= now:
+                    self._remove(exact_key)
+                    continue
+                if cached_vector is None:
+                    continue
+                score = float(np.dot(query, cached_vector))
+                if score >= best_score:
+                    best_key, best_score = exact_key, score
+
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            self.similar_hits += 1
+            return self._entries[best_key][1]
+
+    def put(self, keys: CacheKeys, response: str, vector: Optional[List[float]] = None):
+        """Caches a response, evicting the least recently used entries beyond `max_entries`."""
+        with self._lock:
+            if keys.exact_key in self._entries:
+                self._remove(keys.exact_key)
+            cached_vector = _unit(vector) if vector is not None else None
+            self._entries[keys.exact_key] = (keys.context_key, response, cached_vector, time.monotonic() + self.ttl_s)
+            self._by_context.setdefault(keys.context_key, set()).add(keys.exact_key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and occupancy."""
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.similar_hits) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _remove(self, exact_key: str):
+        # Must be called with self._lock held.
+        context_key = self._entries.pop(exact_key)[0]
+        siblings = self._by_context.get(context_key)
+        if siblings is not None:
+            siblings.discard(exact_key)
+            if not siblings:
+                del self._by_context[context_key]
+
+
+def _unit(vector) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class VectorStoreCache:
+    """
+    A bounded, in-process LRU cache of loaded FAISS vector stores.
+
+    Entries are keyed by GCS prefix and tagged with a version built from the
+    blob generations, so a re-uploaded index is never served stale. The size of
+    an entry is estimated from the total size of its blobs in GCS. For `fresh_s`
+    seconds after its version was last checked, get_recent() serves an entry
+    without asking GCS for the generations again.
+    """
+
+    def __init__(self, max_bytes: int, fresh_s: float = 0.0):
+        self.max_bytes = max_bytes
+        self.fresh_s = fresh_s
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # prefix -> (version, vector_store, size_bytes, checked_at)
+        self._inflight = {}  # (prefix, version) -> Future
+        self._lock = threading.Lock()
+
+    def get_recent(self, prefix: str):
+        """Returns the cached store for `prefix` if its version was checked within `fresh_s`, else None."""
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if not entry or time.monotonic() - entry[3] >= self.fresh_s:
+                return None
+            self._entries.move_to_end(prefix)
+            self.hits += 1
+            return entry[1]
+
+    def get_or_load(self, prefix: str, version: tuple, size_bytes: int, loader):
+        """
+        Returns the cached store for `prefix` if its version matches, otherwise calls
+        `loader()` once and caches the result. Concurrent callers asking for the same
+        prefix and version wait on the same in-flight load.
+        """
+        key = (prefix, version)
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry and entry[0] == version:
+                self._entries[prefix] = entry[:3] + (time.monotonic(),)
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            vector_store = loader()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._inflight.pop(key, None)
+            if vector_store is not None:
+                self._put(prefix, version, vector_store, size_bytes)
+        future.set_result(vector_store)
+        return vector_store
+
+    def invalidate(self, prefix: str):
+        """Drops any cached store for the given prefix."""
+        with self._lock:
+            entry = self._entries.pop(prefix, None)
+            if entry:
+                self.current_bytes -= entry[2]
+
+    def stats(self) -> dict:
+        """Returns hit/miss/eviction counters and current occupancy."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "size_mb": self.current_bytes / (1024 * 1024),
+                "max_size_mb": self.max_bytes / (1024 * 1024),
+            }
+
+    def _put(self, prefix: str, version: tuple, vector_store, size_bytes: int):
+        # Must be called with self._lock held.
+        old = self._entries.pop(prefix, None)
+        if old:
+            self.current_bytes -= old[2]
+
+        # A store larger than the whole budget is served but never cached.
+        if size_bytes > self.max_bytes:
+            return
+
+        while self._entries and self.current_bytes + size_bytes > self.max_bytes:
+            _, (_, _, evicted_size, _) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+
+        self._entries[prefix] = (version, vector_store, size_bytes, time.monotonic())
+        self.current_bytes += size_bytes
+
+
+class VectorStoreDiskCache:
+    """
+    A persistent on-disk copy of vector store blobs, shared by every process on the host.
+
+    Each prefix is stored under a directory named after a hash of its blob generations,
+    so a directory that exists is always complete and current. New versions are
+    downloaded into a staging directory and renamed into place atomically. Once the
+    cache holds more than `max_bytes`, the least recently used versions are removed;
+    each hit refreshes its directory's mtime.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 0):
+        self.cache_dir = os.path.realpath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_local_dir(self, prefix: str, version: tuple, download) -> str:
+        """
+        Returns a local directory holding the blobs for `prefix` at `version`.
+        `download(target_dir)` is only called when no valid copy exists on disk.
+        """
+        prefix_dir = self._prefix_dir(prefix)
+        version_dir = os.path.join(prefix_dir, version_digest(version))
+        if os.path.isdir(version_dir):
+            _touch(version_dir)
+            return version_dir
+
+        os.makedirs(prefix_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix=".staging-", dir=prefix_dir)
+        try:
+            download(staging_dir)
+            os.rename(staging_dir, version_dir)
+        except OSError:
+            # Another worker finished the same download first; use its copy.
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not os.path.isdir(version_dir):
+                raise
+        except Exception:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        _touch(version_dir)
+        self._remove_stale_versions(prefix_dir, keep=os.path.basename(version_dir))
+        if self.max_bytes > 0:
+            self._evict(keep=version_dir)
+        return version_dir
+
+    def invalidate(self, prefix: str):
+        """Removes every cached version of `prefix`, e.g. after its document is deleted."""
+        shutil.rmtree(self._prefix_dir(prefix), ignore_errors=True)
+
+    def _prefix_dir(self, prefix: str) -> str:
+        # Prefixes contain usernames, so make sure one cannot point outside the cache directory.
+        prefix_dir = os.path.realpath(os.path.join(self.cache_dir, prefix))
+        if not prefix_dir.startswith(self.cache_dir + os.sep):
+            raise ValueError(f"Vector store prefix escapes the disk cache: {prefix}")
+        return prefix_dir
+
+    def _remove_stale_versions(self, prefix_dir: str, keep: str):
+        # Files that are still memory-mapped by other processes stay readable after unlinking.
+        for name in os.listdir(prefix_dir):
+            if name != keep and not name.startswith(".staging-"):
+                shutil.rmtree(os.path.join(prefix_dir, name), ignore_errors=True)
+
+    def _evict(self, keep: str):
+        """Removes the least recently used version directories until the cache fits in max_bytes."""
+        versions, total_bytes = [], 0
+        for dir_path, dir_names, file_names in os.walk(self.cache_dir):
+            # Version directories are the leaves named by version_digest; staging directories are skipped.
+            if dir_names or not _VERSION_DIR.fullmatch(os.path.basename(dir_path)):
+                continue
+            size_bytes = sum(_file_size(os.path.join(dir_path, name)) for name in file_names)
+            total_bytes += size_bytes
+            versions.append((_mtime(dir_path), dir_path, size_bytes))
+
+        for _, dir_path, size_bytes in sorted(versions):
+            if total_bytes <= self.max_bytes:
+                break
+            if dir_path == keep:
+                continue
+            shutil.rmtree(dir_path, ignore_errors=True)
+            total_bytes -= size_bytes
+            try:
+                os.rmdir(os.path.dirname(dir_path))  # Drops the prefix directory once it is empty
+            except OSError:
+                pass
+
+
+_VERSION_DIR = re.compile(r"[0-9a-f]{16}")
+
+
+def _touch(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def version_digest(version: tuple) -> str:
+    """Returns a short, stable digest of a vector store version (its blob names and generations)."""
+    return hashlib.sha256(repr(version).encode("utf-8")).hexdigest()[:16]
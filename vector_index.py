@@ -0,0 +1,155 @@
+import gzip
+import json
+import math
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# faiss is imported where first used, like in rag.py, so importing this module stays cheap.
+
+# --- Configuration ---
+# "auto" picks the index format from the chunk count; any of INDEX_TYPES forces that format.
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "auto")
+# Chunk counts at which "auto" moves to float16 vectors, to an inverted-file index, and to product quantization.
+FP16_MIN_CHUNKS = int(os.getenv("VECTOR_INDEX_FP16_MIN_CHUNKS", 1000))
+IVF_MIN_CHUNKS = int(os.getenv("VECTOR_INDEX_IVF_MIN_CHUNKS", 20000))
+PQ_MIN_CHUNKS = int(os.getenv("VECTOR_INDEX_PQ_MIN_CHUNKS", 100000))
+# Inverted lists scanned per query, and the HNSW search breadth. Both are saved with the index.
+IVF_NPROBE = int(os.getenv("VECTOR_INDEX_IVF_NPROBE", 16))
+HNSW_EF_SEARCH = int(os.getenv("VECTOR_INDEX_HNSW_EF_SEARCH", 64))
+# Vectors sampled to train IVF centroids and PQ codebooks, and queries used to measure recall.
+TRAIN_SAMPLE = int(os.getenv("VECTOR_INDEX_TRAIN_SAMPLE", 50000))
+RECALL_QUERIES = int(os.getenv("VECTOR_INDEX_RECALL_QUERIES", 50))
+RECALL_K = 10
+
+INDEX_TYPES = ("flat", "fp16", "hnsw", "ivf", "ivfpq")
+# IVF and PQ need enough vectors to train on: smaller stores fall back to float16, and PQ's
+# 256-centroid codebooks want 39 points per centroid before they are worth using over plain IVF.
+MIN_TRAINABLE_CHUNKS = 1000
+MIN_PQ_CHUNKS = 256 * 39
+# The gzipped docstore takes roughly this many times its stored size once loaded.
+DOCSTORE_EXPANSION = 4
+
+
+def choose_index_type(num_vectors: int, requested: str = VECTOR_INDEX_TYPE) -> str:
+    """Returns the index format for a store of `num_vectors` chunks."""
+    if requested == "auto":
+        if num_vectors >= PQ_MIN_CHUNKS:
+            return "ivfpq"
+        if num_vectors >= IVF_MIN_CHUNKS:
+            return "ivf"
+        return "fp16" if num_vectors >= FP16_MIN_CHUNKS else "flat"
+    if requested not in INDEX_TYPES:
+        raise ValueError(f"Unsupported vector index type: {requested}")
+    if requested in ("ivf", "ivfpq") and num_vectors < MIN_TRAINABLE_CHUNKS:
+        return "fp16"
+    if requested == "ivfpq" and num_vectors < MIN_PQ_CHUNKS:
+        return "ivf"
+    return requested
+
+
+def _factory_string(index_type: str, dim: int, num_vectors: int) -> str:
+    # Around 4 * sqrt(n) lists, with at least the 39 training points per list faiss asks for.
+    nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+    if index_type == "fp16":
+        return "SQfp16"
+    if index_type == "hnsw":
+        return "HNSW32"
+    if index_type == "ivf":
+        return f"IVF{nlist},SQfp16"
+    if index_type == "ivfpq":
+        # One byte per 8 dimensions: 96 bytes per 768-dimension vector instead of 3 KB.
+        subquantizers = max(m for m in range(1, max(dim // 8, 1) + 1) if dim % m == 0)
+        return f"IVF{nlist},PQ{subquantizers}x8"
+    return "Flat"
+
+
+def build_index(vectors: np.ndarray, index_type: str):
+    """Builds an L2 index of the given format over `vectors`, training it on a sample if needed."""
+    import faiss
+    num_vectors, dim = vectors.shape
+    index = faiss.index_factory(dim, _factory_string(index_type, dim, num_vectors), faiss.METRIC_L2)
+    if not index.is_trained:
+        sample = vectors
+        if num_vectors > TRAIN_SAMPLE:
+            sample = vectors[np.random.default_rng(0).choice(num_vectors, TRAIN_SAMPLE, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    if index_type in ("ivf", "ivfpq"):
+        faiss.extract_index_ivf(index).nprobe = IVF_NPROBE
+    elif index_type == "hnsw":
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+
+def measure_recall(index, vectors: np.ndarray, k: int = RECALL_K, num_queries: int = RECALL_QUERIES) -> float:
+    """
+    Returns the index's mean recall@k against exact search over the same vectors.
+    Queries are midpoints of random pairs of chunks, so none of them is itself a stored vector.
+    """
+    import faiss
+    num_vectors = vectors.shape[0]
+    k = min(k, num_vectors)
+    if k == 0 or num_queries == 0:
+        return 1.0
+    rng = np.random.default_rng(0)
+    queries = (vectors[rng.integers(0, num_vectors, num_queries)] + vectors[rng.integers(0, num_vectors, num_queries)]) / 2
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, expected = exact.search(queries, k)
+    _, found = index.search(queries, k)
+    return float(np.mean([len(set(e) & set(f)) / k for e, f in zip(expected, found)]))
+
+
+def compact(index, index_type: Optional[str] = None) -> Tuple[object, Dict]:
+    """
+    Rebuilds a flat index in the format chosen for its size. Returns (index, stats), where stats
+    records the format, chunk count, serialized size and recall@k against the flat index.
+    """
+    import faiss
+    index_type = choose_index_type(index.ntotal, index_type or VECTOR_INDEX_TYPE)
+    if index_type != "flat":
+        vectors = index.reconstruct_n(0, index.ntotal)
+        index = build_index(vectors, index_type)
+        recall = measure_recall(index, vectors)
+    else:
+        recall = 1.0
+    stats = {
+        "index_type": index_type,
+        "chunks": int(index.ntotal),
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+        f"recall_at_{RECALL_K}": recall,
+    }
+    return index, stats
+
+
+# --- Docstore Serialization ---
+# Chunk texts and metadata are stored as gzipped JSON in index order, instead of a pickled docstore.
+DOCSTORE_FILE = "docstore.json.gz"
+
+
+def serialize_docstore(docstore, index_to_docstore_id: Dict[int, str], stats: Optional[Dict] = None) -> bytes:
+    ids = [index_to_docstore_id[i] for i in range(len(index_to_docstore_id))]
+    documents = [docstore.search(doc_id) for doc_id in ids]
+    payload = {
+        "format": 1,
+        "ids": ids,
+        "texts": [doc.page_content for doc in documents],
+        "metadatas": [doc.metadata for doc in documents],
+        "index": stats or {},
+    }
+    return gzip.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"), compresslevel=6)
+
+
+def deserialize_docstore(data: bytes):
+    """Returns (docstore, index_to_docstore_id, index stats) as the LangChain FAISS wrapper expects them."""
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    from langchain_core.documents import Document
+
+    payload = json.loads(gzip.decompress(data))
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=metadata)
+        for doc_id, text, metadata in zip(payload["ids"], payload["texts"], payload["metadatas"])
+    })
+    return docstore, dict(enumerate(payload["ids"])), payload.get("index", {})